@@ -0,0 +1 @@
+"""Micro-benchmarks for the access log tailer (run with python -m)."""
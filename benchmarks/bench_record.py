@@ -0,0 +1,65 @@
+"""Per-line cost of parsing and recording access log lines.
+
+Usage: python -m benchmarks.bench_record [num_lines]
+"""
+
+import datetime
+import sys
+import timeit
+
+from nginx_access_tailer import NginxAccessLogConsumer, NginxAccessLogTailer
+
+LOG_LINE = ('1.2.3.4 - - [%s +0000] "GET /index.html HTTP/1.1" 200 1105 '
+            '"-" "SomeClient"\n')
+
+
+def make_lines(num_lines):
+    """Returns num_lines access log lines timestamped in the future."""
+    now = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    return [LOG_LINE % now.strftime('%d/%b/%Y:%H:%M:%S')] * num_lines
+
+
+def report(name, seconds, num_lines):
+    """Print the per-line cost of a benchmark."""
+    print '%-40s %8.0f ns/line' % (name, 1e9 * seconds / num_lines)
+
+
+def bench(name, func, num_lines, repeat=3):
+    """Time func (processing num_lines lines), reporting the best run."""
+    report(name, min(timeit.repeat(func, number=1, repeat=repeat)), num_lines)
+
+
+def main():
+    """Run the benchmarks."""
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    lines = make_lines(num_lines)
+
+    tailer = NginxAccessLogTailer('/dev/null', None)
+    # pylint: disable=protected-access
+    parse = tailer._parse_nginx_access_log
+    parsed = [parse(line) for line in lines]
+
+    bench('parse', lambda: [parse(line) for line in lines], num_lines)
+
+    consumer = NginxAccessLogConsumer(None, None, 'counts')
+
+    def record():
+        """Record all parsed lines (counts only)."""
+        for groups in parsed:
+            consumer.record(groups)
+
+    bench('record (counts)', record, num_lines)
+
+    consumer_bytes = NginxAccessLogConsumer(
+        None, None, 'counts', http_response_bytes_metric_name='bytes')
+
+    def record_bytes():
+        """Record all parsed lines (counts and bytes sent)."""
+        for groups in parsed:
+            consumer_bytes.record(groups)
+
+    bench('record (counts + bytes sent)', record_bytes, num_lines)
+
+
+if __name__ == '__main__':
+    main()
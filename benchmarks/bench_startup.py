@@ -0,0 +1,112 @@
+"""Daemon startup cost: instance metadata fetches and --help.
+
+Metadata is served by a local stand-in for the GCE metadata service, which
+adds a fixed latency to each response.
+
+Usage: python -m benchmarks.bench_startup [latency_s]
+"""
+
+import BaseHTTPServer
+import os
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from nginx_access_tailer import InstanceMetadata
+
+METADATA = {
+    '/computeMetadata/v1/instance/id': '1234567890',
+    '/computeMetadata/v1/instance/zone': 'projects/123/zones/us-central1-a',
+}
+
+
+class _MetadataServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server, with the response latency as an attribute."""
+    daemon_threads = True
+    latency_s = 0.0
+
+
+class _MetadataHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves METADATA entries after a delay."""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serve a metadata entry."""
+        time.sleep(self.server.latency_s)
+        value = METADATA.get(self.path)
+        if value is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Metadata-Flavor', 'Google')
+        self.end_headers()
+        self.wfile.write(value)
+
+    def log_message(self, *args):
+        """Silence request logging."""
+        pass
+
+
+def report(name, seconds):
+    """Print the duration of a benchmark."""
+    print '%-40s %8.1f ms' % (name, 1e3 * seconds)
+
+
+def timed(func):
+    """Returns the time taken to call func."""
+    t_start = time.time()
+    func()
+    return time.time() - t_start
+
+
+def main():
+    """Run the benchmarks."""
+    latency_s = float(sys.argv[1]) if len(sys.argv) > 1 else 0.1
+    server = _MetadataServer(('127.0.0.1', 0), _MetadataHandler)
+    server.latency_s = latency_s
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = 'http://127.0.0.1:%d/computeMetadata/v1/instance' % (
+        server.server_address[1])
+    tmpdir = tempfile.mkdtemp()
+    cache_file = os.path.join(tmpdir, 'metadata.json')
+    print 'metadata server latency: %.1f ms' % (1e3 * latency_s)
+    try:
+
+        def sequential():
+            """Fetch id and zone one after the other, uncached."""
+            meta = InstanceMetadata(base_url=base_url)
+            meta.instance_id()
+            meta.instance_zone()
+
+        def concurrent():
+            """Fetch id and zone concurrently, populating the cache file."""
+            meta = InstanceMetadata(base_url=base_url, cache_file=cache_file)
+            meta.fetch_all(['id', 'zone'])
+            meta.instance_id()
+            meta.instance_zone()
+
+        report('metadata: sequential', timed(sequential))
+        report('metadata: concurrent (cold cache)', timed(concurrent))
+        report('metadata: cached restart', timed(concurrent))
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir)
+
+    cmd = [sys.executable, '-m', 'nginx_access_tailer', '--help']
+    with open(os.devnull, 'w') as devnull:
+        t_start = time.time()
+        status = subprocess.call(cmd, stdout=devnull, stderr=devnull)
+        elapsed = time.time() - t_start
+    if status == 0:
+        report('--help', elapsed)
+    else:
+        print '--help: failed (exit status %d)' % status
+
+
+if __name__ == '__main__':
+    main()
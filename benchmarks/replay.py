@@ -0,0 +1,287 @@
+"""Record-and-replay harness for end-to-end latency testing.
+
+Replays a captured access log (or synthetic traffic) into a real log file at
+a configurable speed-up, optionally with simulated rename and copytruncate
+rotations, while the real NginxAccessLogTailer / SimpleTailer /
+NginxAccessLogConsumer stack tails it and writes to a recording fake
+monitoring client. Reports end-to-end latency percentiles (from a line being
+written to its count reaching write_point), lost / duplicated lines, and
+tailer CPU time per million lines.
+
+Each replayed line is tagged with a replay_id query parameter in its URL, and
+its timestamp rewritten to the time of writing (so that it is counted by the
+consumer). The consumer's record method is wrapped to note when each line id
+is counted, so lost and duplicated lines are measured independently. Capture
+lines that the tailer cannot parse are skipped. The writer runs in a separate
+process, so that CPU usage measured in this process is that of the tailer.
+
+Rotations must be spaced further apart than the maximum polling period:
+otherwise a rotated log may itself be rotated away (and, for renames,
+overwritten) before the tailer has read it. This is checked for synthetic
+traffic; for captured logs, the spacing depends on the capture and speed-up.
+
+Usage: python -m benchmarks.replay [--log CAPTURE] [--speedup N] ...
+"""
+
+import argparse
+import array
+import bisect
+import datetime
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from nginx_access_tailer import NginxAccessLogConsumer, NginxAccessLogTailer
+
+NGINX_TIMESTAMP_FORMAT = '%d/%b/%Y:%H:%M:%S'
+
+SYNTHETIC_LINE = ('10.0.0.%d - - [07/Aug/2017:00:00:00 +0000] '
+                  '"GET /%d HTTP/1.1" %d 1105 "-" "SomeClient"\n')
+
+TIMESTAMP_RE = re.compile(r'\[([^\]]+)\]')
+
+REPLAY_ID_RE = re.compile(r'replay_id=(\d+)')
+
+
+class RecordingClient(object):
+    """Fake monitoring client, recording the points written to it."""
+
+    def __init__(self):
+        self.points = []
+
+    def metric(self, type_, labels):
+        """Returns a hashable stand-in for a metric object."""
+        return (type_, tuple(sorted(labels.items())))
+
+    def write_point(self, metric, resource, value, start_time=None):
+        """Record a point, along with the time at which it was written."""
+        _ = resource, start_time
+        self.points.append((time.time(), metric, value))
+
+
+def tag_line(match, line_id):
+    """Returns the matched log line with line_id added to its URL."""
+    url = match.group('url')
+    sep = '&' if '?' in url else '?'
+    return '%s%s%sreplay_id=%d%s' % (match.string[:match.start('url')], url,
+                                     sep, line_id,
+                                     match.string[match.end('url'):])
+
+
+def load_schedule(args):
+    """Returns a list of (offset_s, line) pairs to replay.
+
+    Offsets are relative to the first line, divided by the speed-up. The
+    line at index i of the schedule is tagged with replay_id=i.
+    """
+    parser = re.compile(NginxAccessLogTailer.NGINX_ACCESS_LOG_RE)
+    if args.log is None:
+        codes = (200, 200, 200, 200, 301, 404, 500)
+        return [(i / args.synthetic_rate,
+                 tag_line(
+                     parser.match(SYNTHETIC_LINE %
+                                  (i % 256, i, codes[i % len(codes)])), i))
+                for i in xrange(args.synthetic_lines)]
+    schedule = []
+    first = None
+    with open(args.log) as flog:
+        for line in flog:
+            match = parser.match(line)
+            if match is None:
+                continue
+            line = tag_line(match, len(schedule))
+            log_time = datetime.datetime.strptime(
+                match.group('datetime').split(' ')[0], NGINX_TIMESTAMP_FORMAT)
+            if first is None:
+                first = log_time
+            offset_s = (log_time - first).total_seconds() / args.speedup
+            schedule.append((offset_s, line))
+    return schedule
+
+
+def writer_main(args, filename, schedule, start_time, results):
+    """Write the schedule to the log file, putting write times on results.
+
+    For rename rotations, the writer keeps writing to the renamed file for
+    args.reopen_lag_lines lines before reopening the log by name (as nginx
+    does on SIGUSR1). For copytruncate rotations, the writer is unaffected.
+    """
+    rotated = filename + '.1'
+    writer = open(filename, 'a')
+    write_times = array.array('d')
+    reopen_at = None
+    for i, (offset_s, line) in enumerate(schedule):
+        delay_s = start_time + offset_s - time.time()
+        if delay_s > 0:
+            time.sleep(delay_s)
+        if i and args.rename_every and i % args.rename_every == 0:
+            os.rename(filename, rotated)
+            reopen_at = i + args.reopen_lag_lines
+        if i and args.copytruncate_every and i % args.copytruncate_every == 0:
+            shutil.copy(filename, rotated)
+            with open(filename, 'r+') as ftrunc:
+                ftrunc.truncate(0)
+        if reopen_at is not None and i >= reopen_at:
+            writer.close()
+            writer = open(filename, 'a')
+            reopen_at = None
+        now = time.time()
+        line = TIMESTAMP_RE.sub(
+            '[%s +0000]' %
+            datetime.datetime.utcfromtimestamp(now).strftime(
+                NGINX_TIMESTAMP_FORMAT),
+            line,
+            count=1)
+        writer.write(line)
+        writer.flush()
+        write_times.append(now)
+    writer.close()
+    results.put(write_times.tostring())
+
+
+def percentile(values, fraction):
+    """Returns the given percentile (as a fraction) of sorted values."""
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def record_counted(consumer, counted):
+    """Wrap consumer.record to append (time, line id) pairs to counted."""
+    record = consumer.record
+
+    def wrapper(parsed_groups, weight=1):
+        """Note the id of the line, then record it."""
+        match = REPLAY_ID_RE.search(parsed_groups['url'])
+        if match is not None:
+            counted.append((time.time(), int(match.group(1))))
+        record(parsed_groups, weight=weight)
+
+    consumer.record = wrapper
+
+
+def analyze(write_times, counted, points):
+    """Compute per-line latencies, and lost and duplicated line counts.
+
+    A line is taken to have been exported by the first commit (write_point
+    call) at or after it was first counted.
+
+    Returns:
+      (sorted list of latencies in seconds, number of lines never counted,
+      number of times lines were counted more than once)
+    """
+    commit_times = sorted(set(write_time for write_time, _, _ in points))
+    first_counted = {}
+    duplicated = 0
+    for count_time, line_id in counted:
+        if line_id in first_counted:
+            duplicated += 1
+        else:
+            first_counted[line_id] = count_time
+    latencies = []
+    for line_id, count_time in first_counted.iteritems():
+        i = bisect.bisect_left(commit_times, count_time)
+        if i < len(commit_times) and line_id < len(write_times):
+            latencies.append(commit_times[i] - write_times[line_id])
+    lost = sum(1 for line_id in xrange(len(write_times))
+               if line_id not in first_counted)
+    return sorted(latencies), lost, duplicated
+
+
+def main():
+    """Run the replay."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        epilog='Rotations (for synthetic traffic, every N lines at '
+        '--synthetic_rate) must be spaced further apart than '
+        '--max_polling_period_s.')
+    parser.add_argument('--log', help='captured access log to replay '
+                        '(default: synthetic traffic)')
+    parser.add_argument('--speedup', type=float, default=1.0,
+                        help='replay speed-up factor for captured logs')
+    parser.add_argument('--synthetic_lines', type=int, default=100000)
+    parser.add_argument('--synthetic_rate', type=float, default=20000.0,
+                        help='synthetic lines per second')
+    parser.add_argument('--rename_every', type=int, default=0,
+                        help='rename-rotate the log every N lines')
+    parser.add_argument('--reopen_lag_lines', type=int, default=100,
+                        help='lines written to the renamed log before the '
+                        'writer reopens it')
+    parser.add_argument('--copytruncate_every', type=int, default=0,
+                        help='copytruncate-rotate the log every N lines')
+    parser.add_argument('--min_polling_period_s', type=float, default=0.1)
+    parser.add_argument('--max_polling_period_s', type=float, default=1.0)
+    parser.add_argument('--commit_period_s', type=float, default=1.0)
+    parser.add_argument('--drain_timeout_s', type=float, default=10.0,
+                        help='maximum time to wait for counts to catch up '
+                        'after the last line is written')
+    args = parser.parse_args()
+    if args.log is None:
+        for every in (args.rename_every, args.copytruncate_every):
+            spacing_s = every / args.synthetic_rate
+            if every and spacing_s <= args.max_polling_period_s:
+                parser.error('rotations must be spaced further apart than '
+                             '--max_polling_period_s (see --help)')
+
+    schedule = load_schedule(args)
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'access.log')
+    open(filename, 'w').close()
+
+    client = RecordingClient()
+    consumer = NginxAccessLogConsumer(client, None, 'replay/count')
+    counted = []
+    record_counted(consumer, counted)
+    tailer = NginxAccessLogTailer(filename, consumer)
+    watcher = threading.Thread(
+        target=tailer.watch,
+        args=(args.min_polling_period_s, ),
+        kwargs={
+            'max_polling_period_s': args.max_polling_period_s,
+            'commit_period_s': args.commit_period_s
+        })
+    watcher.daemon = True
+
+    cpu_start = sum(os.times()[:2])
+    watcher.start()
+    results = multiprocessing.Queue()
+    writer = multiprocessing.Process(
+        target=writer_main,
+        # Start writing over a second after the consumer's counter reset time,
+        # as log timestamps have a resolution of one second.
+        args=(args, filename, schedule, time.time() + 1.5, results))
+    writer.start()
+    write_times = array.array('d')
+    write_times.fromstring(results.get())
+    writer.join()
+
+    # Wait until no more lines are counted over a full poll and commit (so
+    # that the last counts, and any duplicates, have been written).
+    deadline = time.time() + args.drain_timeout_s
+    num_counted = None
+    while time.time() < deadline and len(counted) != num_counted:
+        num_counted = len(counted)
+        time.sleep(args.commit_period_s + args.max_polling_period_s)
+    cpu_s = sum(os.times()[:2]) - cpu_start
+    shutil.rmtree(tmpdir)
+
+    latencies, lost, duplicated = analyze(write_times, list(counted),
+                                          list(client.points))
+    written = len(write_times)
+    print 'lines written:        %d' % written
+    print 'lines counted:        %d' % (written - lost)
+    print 'lines lost:           %d' % lost
+    print 'lines duplicated:     %d' % duplicated
+    for fraction in (0.5, 0.9, 0.99, 1.0):
+        print 'latency p%-4s         %.3f s' % (
+            '%g' % (100 * fraction), percentile(latencies, fraction))
+    print 'tailer CPU:           %.2f s (%.2f s / million lines)' % (
+        cpu_s, 1e6 * cpu_s / max(1, written))
+
+
+if __name__ == '__main__':
+    main()
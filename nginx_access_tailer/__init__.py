@@ -3,3 +3,4 @@
 from nginx_access_tailer.instance_metadata import InstanceMetadata
 from nginx_access_tailer.nginx_access_log_consumer import NginxAccessLogConsumer
 from nginx_access_tailer.nginx_access_log_tailer import NginxAccessLogTailer
+from nginx_access_tailer.syslog_receiver import SyslogReceiver
@@ -2,55 +2,223 @@
 
 import logging
 import logging.handlers
+import signal
 import sys
 
 import gflags
-from google.cloud import monitoring
-from google.cloud.monitoring import MetricKind, ValueType
-from google.cloud.monitoring import LabelDescriptor, LabelValueType
+
+# Note: google.cloud.monitoring is slow to import, and is only imported in the
+# functions that need it, so that e.g. --help does not pay for it.
 
 from . import InstanceMetadata, NginxAccessLogConsumer, NginxAccessLogTailer
+from . import SyslogReceiver
+from .nginx_access_log_consumer import DIMENSIONS
+from .profiling import Profiler
+from .relay import RelayAggregator, RelayClient
+from .spool import Spool
 
 FLAGS = gflags.FLAGS
 gflags.DEFINE_string('access_log', '/var/log/nginx/access.log',
                      'Nginx access log file.')
+gflags.DEFINE_string(
+    'syslog_listen', '',
+    'If set, receive access log lines sent by nginx over syslog on this '
+    'address, rather than tailing --access_log: either <host>:<port> for UDP '
+    '(e.g. 127.0.0.1:5140) or unix:<path> for a unix datagram socket.')
+gflags.DEFINE_integer('syslog_max_datagram_bytes', 8192,
+                      'Maximum accepted syslog datagram size; larger '
+                      'datagrams are discarded.')
+gflags.DEFINE_integer('syslog_rcvbuf_bytes', 4 << 20,
+                      'Requested syslog socket receive buffer size.')
+gflags.DEFINE_float('metadata_timeout_s', 2.0,
+                    'Timeout for each instance metadata request.')
+gflags.DEFINE_integer('metadata_retries', 2,
+                      'Number of times to retry failed instance metadata '
+                      'requests.')
+gflags.DEFINE_string(
+    'metadata_cache_file', '/var/run/nginx-access-tailer.metadata.json',
+    'File in which to cache instance metadata across restarts; empty to '
+    'disable.')
+gflags.DEFINE_float('metadata_cache_ttl_s', 3600.0,
+                    'Maximum age of cached instance metadata.')
+gflags.DEFINE_boolean(
+    'profile', False,
+    'Profile the exporter for --profile_duration_s after startup. Profiling '
+    'can also be toggled at runtime by sending SIGUSR2.')
+gflags.DEFINE_enum(
+    'profile_mode', 'sample', list(Profiler.MODES),
+    'Profiling mode: sample - low-overhead sampled stacks, written as '
+    'collapsed stacks (default); cprofile - cProfile output, readable with '
+    'pstats.')
+gflags.DEFINE_float('profile_duration_s', 60.0,
+                    'Length of each profiling window.')
+gflags.DEFINE_string(
+    'profile_output_prefix', '/var/run/nginx-access-tailer/profile',
+    'Path prefix of profile output files, suffixed with the start time of '
+    'each profiling window. Files are created exclusively, and their '
+    'directory (if missing) with owner-only permissions.')
 gflags.DEFINE_boolean('help', False, 'Display help text and exit.')
 gflags.DEFINE_string(
     'http_response_metric_name', 'custom.googleapis.com/http_response_count',
     'Name of the custom stackdriver metric you would like to use, including '
     'the stackdriver custom metric prefix.')
+gflags.DEFINE_list(
+    'http_response_dimensions', ['response_code'],
+    'Comma-separated dimensions by which to break down response counts, each '
+    'one of: %s. Changing these requires re-creating the metric. upstream '
+    'requires a trailing upstream="$upstream_addr" field in the nginx '
+    'log_format.' % ', '.join(sorted(DIMENSIONS)))
+gflags.DEFINE_integer(
+    'max_label_sets', 1000,
+    'Maximum number of distinct response count label sets, beyond which '
+    'counts are exported in a single overflow series.')
+gflags.DEFINE_string(
+    'http_response_bytes_metric_name',
+    'custom.googleapis.com/http_response_bytes',
+    'Name of the custom stackdriver metric used to export cumulative '
+    'response body bytes sent by status class, including the stackdriver '
+    'custom metric prefix; empty to disable.')
+gflags.DEFINE_string(
+    'sampling_rate_metric_name',
+    'custom.googleapis.com/http_response_sampling_rate',
+    'Name of the custom stackdriver metric used to export the fraction of log '
+    'lines being counted (less than one in overload mode), including the '
+    'stackdriver custom metric prefix; empty to disable.')
 gflags.DEFINE_enum(
-    'mode', 'export', ['export', 'create_metric', 'delete_metric'],
+    'mode', 'export', ['export', 'create_metric', 'delete_metric', 'aggregate'],
     'Mode of operation: export - export response counts to '
     'custom metric (default); create_metric - create a new '
     'custom metric appropriate for use with this script; '
-    'delete_metric - delete the custom metric from stackdriver.')
-gflags.DEFINE_float('polling_period_s', 30.0,
-                    'Time between periodic log tail checks.')
-gflags.DEFINE_float(
-    'rotation_check_idle_time_s', 120.0,
-    'How long to wait after seeing no further log lines in the '
-    'tailed file before starting rotation checks.')
-gflags.DEFINE_float('rotation_check_period_s', 60.0,
-                    'Period between rotation checks on attempts to retrieve '
-                    'log lines (unsuccessfully) from an idle log file.')
+    'delete_metric - delete the custom metric from stackdriver; '
+    'aggregate - run a relay aggregator on --relay_listen, writing points '
+    'relayed by exporters to stackdriver in batches.')
+gflags.DEFINE_string(
+    'relay_address', '',
+    'If set, relay points to the aggregator at this address (<host>:<port> '
+    'or unix:<path>) rather than writing them to stackdriver directly.')
+gflags.DEFINE_string('relay_listen', '127.0.0.1:5141',
+                     'Address on which the relay aggregator listens '
+                     '(<host>:<port> or unix:<path>).')
+gflags.DEFINE_float('relay_flush_period_s', 60.0,
+                    'Time between batched writes by the relay aggregator.')
+gflags.DEFINE_string(
+    'spool_dir', '/var/spool/nginx-access-tailer',
+    'Directory in which to spool points that could not be written to '
+    'stackdriver, for replay once writes succeed; empty to disable. Not used '
+    'with --relay_address.')
+gflags.DEFINE_integer('spool_max_bytes', 64 << 20,
+                      'Maximum size of the spool, beyond which the oldest '
+                      'spooled points are dropped.')
+gflags.DEFINE_integer('spool_replay_max_points', 500,
+                      'Maximum number of spooled points to replay per '
+                      'commit.')
+gflags.DEFINE_float('rotation_check_idle_time_s', None,
+                    'Deprecated and ignored: log rotation is checked on '
+                    'every tail check.')
+gflags.DEFINE_float('rotation_check_period_s', None,
+                    'Deprecated and ignored: log rotation is checked on '
+                    'every tail check.')
+gflags.DEFINE_float('polling_period_s', None,
+                    'Deprecated: sets --max_polling_period_s (and lowers '
+                    '--min_polling_period_s to match, if greater).')
+gflags.DEFINE_float('min_polling_period_s', 1.0,
+                    'Minimum time between periodic log tail checks, used '
+                    'when the log is busy.')
+gflags.DEFINE_float('max_polling_period_s', 30.0,
+                    'Maximum time between periodic log tail checks, used '
+                    'when the log is idle.')
+gflags.DEFINE_integer('polling_target_batch_lines', 1000,
+                      'Desired number of log lines per tail check; sets the '
+                      'polling period from the observed line arrival rate.')
+gflags.DEFINE_float('commit_period_s', 60.0,
+                    'Time between writes of updated counters to stackdriver; '
+                    'should not be less than the minimum spacing between '
+                    'points allowed by the monitoring API.')
+gflags.DEFINE_integer('max_read_bytes', 16 << 20,
+                      'Approximate maximum number of bytes to read from the '
+                      'log per tail check.')
+gflags.DEFINE_integer('max_lag_bytes', 64 << 20,
+                      'Unread log backlog (bytes) above which overload mode '
+                      'is entered, sampling log lines rather than counting '
+                      'them all.')
+gflags.DEFINE_float('max_lag_s', 300.0,
+                    'Time spent behind the end of the log above which '
+                    'overload mode is entered.')
+gflags.DEFINE_integer('overload_sample_every', 10,
+                      'Count one in this many log lines in overload mode.')
 
 
-def create_metric(metric_name):
-    """Create the custom HTTP response by status count metric.
+def create_metric(metric_name, dimensions):
+    """Create the custom HTTP response count metric.
 
     Args:
       metric_name: the name (including prefix) of the response count metric to create.
+      dimensions: names of the dimensions (see DIMENSIONS) by which response
+        counts are broken down.
     """
+    from google.cloud import monitoring
+    from google.cloud.monitoring import LabelDescriptor, LabelValueType
+    from google.cloud.monitoring import MetricKind, ValueType
+    client = monitoring.Client()
+    labels = [
+        LabelDescriptor(
+            dimension,
+            getattr(LabelValueType, DIMENSIONS[dimension].value_type),
+            description=DIMENSIONS[dimension].description)
+        for dimension in dimensions
+    ]
+    descriptor = client.metric_descriptor(
+        metric_name,
+        metric_kind=MetricKind.CUMULATIVE,
+        value_type=ValueType.INT64,
+        labels=labels,
+        description='Cumulative count of HTTP responses by %s.' %
+        ', '.join(dimensions))
+    descriptor.create()
+    logging.info('Created metric: %s', metric_name)
+
+
+def create_bytes_metric(metric_name):
+    """Create the custom HTTP response bytes sent by status class metric.
+
+    Args:
+      metric_name: the name (including prefix) of the metric to create.
+    """
+    from google.cloud import monitoring
+    from google.cloud.monitoring import LabelDescriptor, LabelValueType
+    from google.cloud.monitoring import MetricKind, ValueType
     client = monitoring.Client()
     label = LabelDescriptor(
-        'response_code', LabelValueType.INT64, description='HTTP status code')
+        'status_class',
+        getattr(LabelValueType, DIMENSIONS['status_class'].value_type),
+        description=DIMENSIONS['status_class'].description)
     descriptor = client.metric_descriptor(
         metric_name,
         metric_kind=MetricKind.CUMULATIVE,
         value_type=ValueType.INT64,
         labels=[label],
-        description='Cumulative count of HTTP responses by status code.')
+        unit='By',
+        description='Cumulative HTTP response body bytes sent by status '
+        'class.')
+    descriptor.create()
+    logging.info('Created metric: %s', metric_name)
+
+
+def create_sampling_rate_metric(metric_name):
+    """Create the custom log line sampling rate metric.
+
+    Args:
+      metric_name: the name (including prefix) of the metric to create.
+    """
+    from google.cloud import monitoring
+    from google.cloud.monitoring import MetricKind, ValueType
+    client = monitoring.Client()
+    descriptor = client.metric_descriptor(
+        metric_name,
+        metric_kind=MetricKind.GAUGE,
+        value_type=ValueType.DOUBLE,
+        description='Fraction of access log lines counted toward HTTP '
+        'response counts.')
     descriptor.create()
     logging.info('Created metric: %s', metric_name)
 
@@ -61,12 +229,30 @@ def delete_metric(metric_name):
     Args:
       metric_name: the name (including prefix) of the custom metric to delete.
     """
+    from google.cloud import monitoring
     client = monitoring.Client()
     descriptor = client.metric_descriptor(metric_name)
     descriptor.delete()
     logging.info('Deleted metric: %s', metric_name)
 
 
+def manage_optional_metric(function, metric_name):
+    """Create or delete an optional metric, which may (not) already exist.
+
+    Optional metrics are enabled by default, so may never have been created
+    (or may already have been, before the response count metric).
+
+    Args:
+      function: create or delete function, taking the metric name.
+      metric_name: the name (including prefix) of the metric.
+    """
+    from google.cloud.exceptions import Conflict, NotFound
+    try:
+        function(metric_name)
+    except (Conflict, NotFound) as err:
+        logging.warning('Skipping metric %s: %s', metric_name, err)
+
+
 def main():
     """Run the tailer."""
     try:
@@ -80,6 +266,12 @@ def main():
         print 'Usage: %s ARGS\n%s' % (sys.argv[0], FLAGS)
         return
 
+    for dimension in FLAGS.http_response_dimensions:
+        if dimension not in DIMENSIONS:
+            print 'Unknown dimension: %s\nUsage: %s ARGS\n%s' % (
+                dimension, sys.argv[0], FLAGS)
+            sys.exit(1)
+
     # Setup logging: Send to syslog.
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
@@ -89,27 +281,62 @@ def main():
     handler.setFormatter(fmt)
     logger.addHandler(handler)
 
+    if (FLAGS.rotation_check_idle_time_s is not None or
+            FLAGS.rotation_check_period_s is not None):
+        logging.warning('--rotation_check_idle_time_s and '
+                        '--rotation_check_period_s are deprecated and ignored')
+
     # Handle other modes of operation:
     if FLAGS.mode == 'create_metric':
-        create_metric(FLAGS.http_response_metric_name)
+        create_metric(FLAGS.http_response_metric_name,
+                      FLAGS.http_response_dimensions)
+        if FLAGS.http_response_bytes_metric_name:
+            manage_optional_metric(create_bytes_metric,
+                                   FLAGS.http_response_bytes_metric_name)
+        if FLAGS.sampling_rate_metric_name:
+            manage_optional_metric(create_sampling_rate_metric,
+                                   FLAGS.sampling_rate_metric_name)
         return
     elif FLAGS.mode == 'delete_metric':
         delete_metric(FLAGS.http_response_metric_name)
+        if FLAGS.http_response_bytes_metric_name:
+            manage_optional_metric(delete_metric,
+                                   FLAGS.http_response_bytes_metric_name)
+        if FLAGS.sampling_rate_metric_name:
+            manage_optional_metric(delete_metric,
+                                   FLAGS.sampling_rate_metric_name)
+        return
+    elif FLAGS.mode == 'aggregate':
+        from google.cloud import monitoring
+        aggregator = RelayAggregator(
+            monitoring.Client(),
+            FLAGS.relay_listen,
+            flush_period_s=FLAGS.relay_flush_period_s)
+        aggregator.serve_forever()
         return
 
     # Fetch required metadata.
-    meta = InstanceMetadata()
-    instance_id = meta.instance_id()
+    meta = InstanceMetadata(
+        timeout_s=FLAGS.metadata_timeout_s,
+        retries=FLAGS.metadata_retries,
+        cache_file=FLAGS.metadata_cache_file or None,
+        cache_ttl_s=FLAGS.metadata_cache_ttl_s)
+    metadata = meta.fetch_all(['id', 'zone'])
+    instance_id = metadata['id']
     if instance_id is None:
         logging.critical('Could not fetch instance id')
         sys.exit(1)
-    instance_zone = meta.instance_zone()
-    if instance_zone is None:
+    if metadata['zone'] is None:
         logging.critical('Could not fetch instance zone')
         sys.exit(1)
+    instance_zone = InstanceMetadata.short_zone(metadata['zone'])
 
     # Create logging client and resource object.
-    client = monitoring.Client()
+    if FLAGS.relay_address:
+        client = RelayClient(FLAGS.relay_address)
+    else:
+        from google.cloud import monitoring
+        client = monitoring.Client()
     resource = client.resource(
         'gce_instance',
         labels={'instance_id': instance_id,
@@ -118,12 +345,74 @@ def main():
                  '(instance: %s; zone: %s)', instance_id, instance_zone)
 
     # Initialize consumer and tailer.
-    consumer = NginxAccessLogConsumer(client, resource,
-                                      FLAGS.http_response_metric_name)
-    tailer = NginxAccessLogTailer(FLAGS.access_log, consumer,
-                                  FLAGS.rotation_check_idle_time_s,
-                                  FLAGS.rotation_check_period_s)
+    spool = None
+    if FLAGS.spool_dir and not FLAGS.relay_address:
+        try:
+            spool = Spool(FLAGS.spool_dir, max_bytes=FLAGS.spool_max_bytes)
+        except (IOError, OSError) as err:
+            logging.warning('Could not open spool in %s: %s', FLAGS.spool_dir,
+                            err)
+    consumer = NginxAccessLogConsumer(
+        client,
+        resource,
+        FLAGS.http_response_metric_name,
+        sampling_rate_metric_name=FLAGS.sampling_rate_metric_name or None,
+        dimensions=FLAGS.http_response_dimensions,
+        max_label_sets=FLAGS.max_label_sets,
+        http_response_bytes_metric_name=(
+            FLAGS.http_response_bytes_metric_name or None),
+        spool=spool,
+        spool_replay_max_points=FLAGS.spool_replay_max_points)
+    source = None
+    if FLAGS.syslog_listen:
+        source = SyslogReceiver(
+            FLAGS.syslog_listen,
+            max_datagram_bytes=FLAGS.syslog_max_datagram_bytes,
+            rcvbuf_bytes=FLAGS.syslog_rcvbuf_bytes)
+    tailer = NginxAccessLogTailer(
+        FLAGS.access_log,
+        consumer,
+        max_read_bytes=FLAGS.max_read_bytes,
+        max_lag_bytes=FLAGS.max_lag_bytes,
+        max_lag_s=FLAGS.max_lag_s,
+        overload_sample_every=FLAGS.overload_sample_every,
+        source=source,
+        log_regex=(NginxAccessLogTailer.NGINX_ACCESS_LOG_UPSTREAM_RE
+                   if 'upstream' in FLAGS.http_response_dimensions else None))
+
+    # Profile on request; per-stage times are logged with each profile.
+    profiler = Profiler(
+        FLAGS.profile_output_prefix,
+        duration_s=FLAGS.profile_duration_s,
+        mode=FLAGS.profile_mode,
+        stage_timer=tailer.stage_timer())
+
+    def toggle_profiler(signum, frame):
+        """Start or stop a profiling window."""
+        _ = signum, frame
+        if profiler.active():
+            profiler.stop()
+        else:
+            profiler.start()
+
+    signal.signal(signal.SIGUSR2, toggle_profiler)
+    # Restart system calls (e.g. reads of the log) interrupted by the signal.
+    signal.siginterrupt(signal.SIGUSR2, False)
+    if FLAGS.profile:
+        profiler.start()
 
     # Enter loop ...
     logging.info('Entering polling loop')
-    tailer.watch(FLAGS.polling_period_s)
+    min_polling_period_s = FLAGS.min_polling_period_s
+    max_polling_period_s = FLAGS.max_polling_period_s
+    if FLAGS.polling_period_s is not None:
+        logging.warning('--polling_period_s is deprecated; use '
+                        '--max_polling_period_s')
+        max_polling_period_s = FLAGS.polling_period_s
+        min_polling_period_s = min(min_polling_period_s, max_polling_period_s)
+    tailer.watch(
+        min_polling_period_s,
+        max_polling_period_s=max_polling_period_s,
+        commit_period_s=FLAGS.commit_period_s,
+        target_batch_lines=FLAGS.polling_target_batch_lines,
+        profiler=profiler)
@@ -1,30 +1,175 @@
 """Helpers for accessing the GCE instance metadata service."""
 
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
 import urllib2
 
 
+def _parse_cache(data):
+    """Returns the entry => (value, fetch time) cache in loaded JSON data.
+
+    Entries that are not [string value, numeric fetch time] pairs are ignored.
+    """
+    if not isinstance(data, dict):
+        logging.info('Not using metadata cache file: not an object')
+        return {}
+    cache = {}
+    for entry, cached in data.items():
+        if (isinstance(cached, list) and len(cached) == 2 and
+                isinstance(cached[0], basestring) and
+                isinstance(cached[1], (int, long, float)) and
+                not isinstance(cached[1], bool)):
+            cache[entry] = tuple(cached)
+        else:
+            logging.info('Ignoring invalid metadata cache entry: %s', entry)
+    return cache
+
+
 class InstanceMetadata(object):
-    """Simple helper for fetching instance metadata."""
+    """Simple helper for fetching instance metadata.
+
+    Requests are made with a timeout and retried on failure. Successfully
+    fetched entries are memoized and, if a cache file is provided, persisted
+    there for cache_ttl_s seconds, so that restarts need not wait on the
+    metadata service.
+    """
 
     BASE_URL = 'http://metadata.google.internal/computeMetadata/v1/instance'
 
-    def fetch(self, entry):
+    def __init__(self,
+                 timeout_s=2.0,
+                 retries=2,
+                 retry_delay_s=0.5,
+                 cache_file=None,
+                 cache_ttl_s=3600.0,
+                 base_url=None):
+        """Create the helper.
+
+        Args:
+          timeout_s: timeout for each metadata request (seconds; default: 2).
+          retries: number of times to retry a failed request (default: 2).
+          retry_delay_s: delay before the first retry, doubling for each
+            subsequent retry (seconds; default: 0.5).
+          cache_file: path of a file in which to cache fetched entries
+            (optional; default: no file cache).
+          cache_ttl_s: maximum age of cached entries (seconds; default: 3600).
+          base_url: metadata service URL prefix (default: BASE_URL).
+        """
+        self._timeout_s = timeout_s
+        self._retries = retries
+        self._retry_delay_s = retry_delay_s
+        self._cache_file = cache_file
+        self._cache_ttl_s = cache_ttl_s
+        self._base_url = base_url or self.BASE_URL
+        self._cache = None
+        self._cache_lock = threading.Lock()
+
+    def _load_cache(self):
+        """Returns the entry => (value, fetch time) cache, loading if needed."""
+        with self._cache_lock:
+            if self._cache is None:
+                self._cache = {}
+                if self._cache_file is not None:
+                    try:
+                        with open(self._cache_file) as fcache:
+                            self._cache = _parse_cache(json.load(fcache))
+                    except (IOError, ValueError) as err:
+                        logging.info('Not using metadata cache file: %s', err)
+            return self._cache
+
+    def _save_cache(self):
+        """Atomically write the cache to the cache file, if configured."""
+        if self._cache_file is None:
+            return
+        with self._cache_lock:
+            data = json.dumps(self._cache)
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self._cache_file)))
+            with os.fdopen(fd, 'w') as fcache:
+                fcache.write(data)
+            os.rename(tmp_path, self._cache_file)
+        except (IOError, OSError) as err:
+            logging.warning('Could not write metadata cache file: %s', err)
+
+    def _cached(self, entry):
+        """Returns the cached value of entry, or None if absent or expired."""
+        cached = self._load_cache().get(entry)
+        if cached is None:
+            return None
+        value, fetch_time = cached
+        if not 0 <= time.time() - fetch_time <= self._cache_ttl_s:
+            return None
+        return value
+
+    def fetch(self, entry, save=True):
         """Fetch the requested instance metadata entry.
 
         Args:
           entry: entry name relative to the computeMetadata/v1/instance prefix
+          save: whether to write the cache file if a value was fetched.
 
         Returns:
-          The value read from the metadata service or None on error.
+          The value read from the metadata service (or cache) or None on
+          error.
         """
+        value = self._cached(entry)
+        if value is not None:
+            return value
         request = urllib2.Request(
-            url='%s/%s' % (self.BASE_URL, entry),
+            url='%s/%s' % (self._base_url, entry),
             headers={'Metadata-Flavor': 'Google'})
-        try:
-            instance_id = urllib2.urlopen(request).read()
-        except urllib2.URLError:
-            instance_id = None
-        return instance_id
+        delay_s = self._retry_delay_s
+        for attempt in range(self._retries + 1):
+            if attempt:
+                time.sleep(delay_s)
+                delay_s *= 2
+            try:
+                value = urllib2.urlopen(request, timeout=self._timeout_s).read()
+                break
+            except (urllib2.URLError, socket.error) as err:
+                logging.warning('Could not fetch metadata %s (attempt %d): %s',
+                                entry, attempt + 1, err)
+        if value is not None:
+            with self._cache_lock:
+                self._cache[entry] = (value, time.time())
+            if save:
+                self._save_cache()
+        return value
+
+    def fetch_all(self, entries):
+        """Fetch several instance metadata entries concurrently.
+
+        Args:
+          entries: list of entry names (see fetch).
+
+        Returns:
+          dict of entry name => value (or None on error).
+        """
+        values = {}
+
+        def fetch_one(entry):
+            """Fetch a single entry, without writing the cache file."""
+            values[entry] = self.fetch(entry, save=False)
+
+        threads = []
+        for entry in entries:
+            values[entry] = self._cached(entry)
+            if values[entry] is None:
+                thread = threading.Thread(target=fetch_one, args=(entry,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if any(values[entry] is not None for entry in entries) and threads:
+            self._save_cache()
+        return values
 
     def instance_id(self):
         """Fetch the instance id."""
@@ -34,5 +179,10 @@ class InstanceMetadata(object):
         """Fetch the instance zone."""
         zone = self.fetch('zone')
         if zone is not None and shorten:
-            zone = zone.split('/')[-1]
+            zone = self.short_zone(zone)
         return zone
+
+    @staticmethod
+    def short_zone(zone):
+        """Returns the zone name of a zone entry ('projects/.../zones/x')."""
+        return zone.split('/')[-1]
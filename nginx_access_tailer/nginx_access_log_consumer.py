@@ -1,8 +1,47 @@
 """Consumer responsible for writing to stackdriver and associated helpers."""
 
+import collections
 import logging
 from datetime import tzinfo, timedelta, datetime
 
+from nginx_access_tailer.spool import SpooledPoint
+
+
+def _last_upstream(upstream_addr):
+    """Returns the upstream that served a request, given $upstream_addr.
+
+    $upstream_addr lists each upstream tried, separated by ', ' (retries) or
+    ' : ' (internal redirects); the last one produced the response.
+    """
+    if not upstream_addr:
+        return '-'
+    return upstream_addr.replace(' : ', ', ').rsplit(', ', 1)[-1]
+
+
+Dimension = collections.namedtuple(
+    'Dimension', ['value_type', 'description', 'overflow_value', 'extract'])
+
+# Supported response count dimensions, by label name. The value type names a
+# google.cloud.monitoring.LabelValueType member; extract maps the parsed log
+# line groups and integer status code to the (string) label value.
+DIMENSIONS = {
+    'response_code':
+    Dimension('INT64', 'HTTP status code', '0',
+              lambda groups, code: str(code)),
+    'status_class':
+    Dimension('STRING', 'HTTP status class (e.g. 2xx)', 'other',
+              lambda groups, code: '%dxx' % (code // 100)),
+    'method':
+    Dimension('STRING', 'HTTP request method', 'other',
+              lambda groups, code: groups.get('method') or '-'),
+    'http_version':
+    Dimension('STRING', 'HTTP protocol version', 'other',
+              lambda groups, code: groups.get('httpversion') or '-'),
+    'upstream':
+    Dimension('STRING', 'Upstream server address', 'other',
+              lambda groups, code: _last_upstream(groups.get('upstream'))),
+}
+
 
 class _FixedOffsetTimeZone(tzinfo):
     """Hack for dealing w/ lack of %z in 2.7 strptime.
@@ -27,30 +66,142 @@ class _FixedOffsetTimeZone(tzinfo):
         return timedelta(0)
 
 
+class _CounterStore(object):
+    """Counters keyed by label set, with a cap on the number of label sets.
+
+    Label value tuples are interned to compact integer keys, indexing into
+    flat lists of label sets and counts. Once max_label_sets distinct label
+    sets have been seen, further new ones are counted in a single overflow
+    series, whose label values are given by each dimension's overflow_value.
+    """
+
+    def __init__(self, dimensions, max_label_sets):
+        """Create the counter store.
+
+        Args:
+          dimensions: sequence of dimension names (keys of DIMENSIONS).
+          max_label_sets: maximum number of distinct label sets, excluding the
+            overflow series.
+        """
+        self._dimensions = tuple(dimensions)
+        self._extractors = tuple(DIMENSIONS[d].extract for d in dimensions)
+        self._overflow_labels = tuple(
+            DIMENSIONS[d].overflow_value for d in dimensions)
+        self._max_label_sets = max_label_sets
+        self._keys = {}
+        self._label_sets = []
+        self._counts = []
+
+    def _intern(self, labels):
+        """Return the key for a label set not seen before."""
+        if len(self._label_sets) >= self._max_label_sets:
+            key = self._keys.get(self._overflow_labels)
+            if key is not None:
+                return key
+            logging.warning(
+                'Reached limit of %d label sets for %s: counting further '
+                'label sets as %s', self._max_label_sets,
+                str(self._dimensions), str(self._overflow_labels))
+            labels = self._overflow_labels
+        key = len(self._label_sets)
+        self._keys[labels] = key
+        self._label_sets.append(labels)
+        self._counts.append(0)
+        return key
+
+    def add(self, parsed_groups, code, weight):
+        """Add to the counter for the label set of the parsed log line.
+
+        Args:
+          parsed_groups: dict of str => str elements from an access log line.
+          code: integer HTTP status code.
+          weight: amount to add.
+        """
+        labels = tuple(extract(parsed_groups, code)
+                       for extract in self._extractors)
+        key = self._keys.get(labels)
+        if key is None:
+            key = self._intern(labels)
+        self._counts[key] += weight
+
+    def labels(self, key):
+        """Returns the label name => value dict for the provided key."""
+        return dict(zip(self._dimensions, self._label_sets[key]))
+
+    def items(self):
+        """Returns a list of (key, count) pairs, in order of first use."""
+        return list(enumerate(self._counts))
+
+    def __str__(self):
+        return str(dict(zip(self._label_sets, self._counts)))
+
+
 class NginxAccessLogConsumer(object):
     """Consumes nginx log lines and exports to custom stackdriver metrics.
 
-    Currently only supports exporting request counts by status code.
+    Currently only supports exporting request counts, broken down by a
+    configurable set of dimensions (see DIMENSIONS; default: status code),
+    along with (optionally) cumulative response body bytes sent by status
+    class and the rate at which log lines are being sampled.
     """
 
     NGINX_BASE_TIMESTAMP_FORMAT = '%d/%b/%Y:%H:%M:%S'
 
-    def __init__(self, client, resource, http_response_metric_name):
+    def __init__(self,
+                 client,
+                 resource,
+                 http_response_metric_name,
+                 sampling_rate_metric_name=None,
+                 dimensions=('response_code',),
+                 max_label_sets=1000,
+                 http_response_bytes_metric_name=None,
+                 spool=None,
+                 spool_replay_max_points=500):
         """Initialize NginxAccessLogConsumer.
 
         Args:
           client: cloud monitoring client.
           resource: resource object identifying the monitored instance.
+          http_response_metric_name: name of the response count metric.
+          sampling_rate_metric_name: name of the sampling rate gauge metric
+            (optional; default: sampling rate is not exported).
+          dimensions: names of the dimensions (see DIMENSIONS) by which to
+            break down response counts (default: response_code only).
+          max_label_sets: maximum number of distinct response count label
+            sets, beyond which counts go to an overflow series (default:
+            1000).
+          http_response_bytes_metric_name: name of the response body bytes
+            sent metric (optional; default: bytes sent are not exported).
+          spool: Spool in which to keep points that could not be written, for
+            later replay (optional; default: such points are dropped).
+          spool_replay_max_points: maximum number of spooled points to replay
+            per commit (default: 500).
         """
         self._client = client
         self._resource = resource
         self._reset_time_utc = datetime.utcnow()
         self._reset_time_utc_offset = self._reset_time_utc.replace(
             tzinfo=_FixedOffsetTimeZone(0))
-        self._response_codes = {}
-        self._response_code_metrics = {}
+        self._response_counts = _CounterStore(dimensions, max_label_sets)
+        self._response_count_metrics = {}
         self._has_delta = False
         self._http_response_metric_name = http_response_metric_name
+        self._http_response_bytes_metric_name = http_response_bytes_metric_name
+        self._response_bytes = None
+        self._response_bytes_metrics = {}
+        if http_response_bytes_metric_name is not None:
+            self._response_bytes = _CounterStore(('status_class',),
+                                                 max_label_sets)
+        self._sampling_rate = 1.0
+        self._sampling_rate_metric_name = sampling_rate_metric_name
+        self._sampling_rate_metric = None
+        self._sampling_rate_written = None
+        self._spool = spool
+        self._spool_replay_max_points = spool_replay_max_points
+        self._spooled_metrics = {}
+        # Latest point per series (keyed by metric name and labels), held
+        # back while the spool drains.
+        self._deferred = collections.OrderedDict()
 
     def _parse_nginx_timestamp(self, ts_str):
         """Parse the provided timestamp string.
@@ -76,12 +227,23 @@ class NginxAccessLogConsumer(object):
         """
         return self._reset_time_utc
 
-    def record(self, parsed_groups):
+    def set_sampling_rate(self, rate):
+        """Set the fraction of log lines currently being recorded.
+
+        Args:
+          rate: sampling rate in (0, 1]; exported on the next commit.
+        """
+        self._sampling_rate = rate
+
+    def record(self, parsed_groups, weight=1):
         """Record supported metrics from the parsed log line.
 
         Args:
           parsed_groups: dict of str => str elements from an nginx access log
-            line; only relevant fields are datetime and statuscode.
+            line; only required fields are datetime and statuscode, with
+            bytessent also used if exporting bytes sent.
+          weight: number of log lines this line stands for (e.g. when
+            sampling; default: 1).
         """
         log_time = self._parse_nginx_timestamp(parsed_groups['datetime'])
         if log_time is None:
@@ -96,25 +258,177 @@ class NginxAccessLogConsumer(object):
             logging.warn('Could not parse statuscode: "%s"',
                          parsed_groups['statuscode'])
             return
-        if code not in self._response_codes:
-            self._response_codes[code] = 0
-        self._response_codes[code] += 1
+        self._response_counts.add(parsed_groups, code, weight)
+        if self._response_bytes is not None:
+            try:
+                num_bytes = int(parsed_groups['bytessent'])
+            except (KeyError, ValueError):
+                logging.warn('Could not parse bytessent: "%s"',
+                             parsed_groups.get('bytessent'))
+            else:
+                self._response_bytes.add(parsed_groups, code,
+                                         num_bytes * weight)
         self._has_delta = True
 
+    def _sampling_rate_points(self):
+        """Returns the sampling rate point, if it or the counts have changed."""
+        if self._sampling_rate_metric_name is None:
+            return []
+        if (not self._has_delta and
+                self._sampling_rate == self._sampling_rate_written):
+            return []
+        if self._sampling_rate_metric is None:
+            self._sampling_rate_metric = self._client.metric(
+                type_=self._sampling_rate_metric_name, labels={})
+        self._sampling_rate_written = self._sampling_rate
+        return [(self._sampling_rate_metric, self._sampling_rate_metric_name,
+                 {}, self._sampling_rate, None)]
+
+    def _counter_points(self, counters, metrics, metric_name):
+        """Returns points for the cumulative counters in a counter store.
+
+        Args:
+          counters: the _CounterStore to write.
+          metrics: dict of counter store key => metric object, updated with
+            any newly created metric objects.
+          metric_name: the name of the metric to write to.
+
+        Returns:
+          list of (metric object, metric name, labels, value, start time).
+        """
+        logging.info('Writing updated counters to %s: %s', metric_name,
+                     str(counters))
+        points = []
+        for key, count in counters.items():
+            labels = counters.labels(key)
+            if key not in metrics:
+                metrics[key] = self._client.metric(
+                    type_=metric_name, labels=labels)
+            points.append((metrics[key], metric_name, labels, count,
+                           self._reset_time_utc))
+        return points
+
+    def _write_points(self, points):
+        """Write points, spooling them if they cannot be written.
+
+        Args:
+          points: list of (metric object, metric name, labels, value, start
+            time), with a start time of None for gauges.
+
+        Returns:
+          True if all points were either written or spooled.
+        """
+        for i, (metric, _, _, value, start_time) in enumerate(points):
+            try:
+                if start_time is None:
+                    self._client.write_point(metric, self._resource, value)
+                else:
+                    self._client.write_point(
+                        metric, self._resource, value, start_time=start_time)
+            except Exception as err:  # pylint: disable=broad-except
+                logging.error('Failed to write points: %s', err)
+                return self._spool_points(points[i:], datetime.utcnow())
+        return True
+
+    def _spool_points(self, points, end_time):
+        """Append points, as of end_time, to the spool.
+
+        Returns:
+          True if the points were spooled.
+        """
+        if self._spool is None:
+            return False
+        if not points:
+            return True
+        logging.warning('Spooling %d points', len(points))
+        try:
+            self._spool.append([
+                SpooledPoint(metric_name, labels, value, start_time, end_time)
+                for _, metric_name, labels, value, start_time in points
+            ])
+        except (IOError, OSError) as err:
+            logging.error('Failed to spool points: %s', err)
+            return False
+        return True
+
+    def _replay_spool(self):
+        """Write up to spool_replay_max_points spooled points, oldest first."""
+        advanced = False
+        for _ in range(self._spool_replay_max_points):
+            try:
+                point = self._spool.peek()
+            except (IOError, OSError) as err:
+                logging.error('Failed to read spool: %s', err)
+                break
+            if point is None:
+                break
+            key = (point.metric_type, tuple(sorted(point.labels.items())))
+            metric = self._spooled_metrics.get(key)
+            if metric is None:
+                metric = self._client.metric(
+                    type_=point.metric_type, labels=point.labels)
+                self._spooled_metrics[key] = metric
+            try:
+                if point.start_time is None:
+                    self._client.write_point(
+                        metric, self._resource, point.value,
+                        end_time=point.end_time)
+                else:
+                    self._client.write_point(
+                        metric, self._resource, point.value,
+                        end_time=point.end_time, start_time=point.start_time)
+            except Exception as err:  # pylint: disable=broad-except
+                # Client errors (other than rate limiting) will not succeed on
+                # retry, so the point is dropped.
+                code = getattr(err, 'code', None)
+                if not (isinstance(code, int) and 400 <= code < 500 and
+                        code != 429):
+                    logging.warning('Spool replay failed; will retry: %s',
+                                    err)
+                    break
+                logging.warning('Dropping spooled point: %s', err)
+            self._spool.advance()
+            advanced = True
+        if not advanced:
+            return
+        try:
+            self._spool.sync_head()
+        except (IOError, OSError) as err:
+            logging.error('Failed to save spool read position: %s', err)
+
     def commit(self):
-        """Write the supported metrics to cloud monitoring."""
+        """Write the supported metrics to cloud monitoring.
+
+        If a spool is configured, points that cannot be written are spooled,
+        and spooled points replayed at up to spool_replay_max_points per
+        commit. While the spool is not empty, only the latest point of each
+        series is kept (in memory), to be written once the spool has drained,
+        so that each series is written in order. Otherwise (or if spooling
+        fails), failed writes are logged and retried (with the latest
+        cumulative counts) on the next commit.
+        """
+        points = self._sampling_rate_points()
         if self._has_delta:
-            logging.info('Writing updated counters to %s: %s',
-                         self._http_response_metric_name,
-                         str(self._response_codes))
-            for code, count in self._response_codes.iteritems():
-                if code not in self._response_code_metrics:
-                    self._response_code_metrics[code] = self._client.metric(
-                        type_=self._http_response_metric_name,
-                        labels={'response_code': str(code)})
-                self._client.write_point(
-                    self._response_code_metrics[code],
-                    self._resource,
-                    count,
-                    start_time=self._reset_time_utc)
-            self._has_delta = False
+            points.extend(
+                self._counter_points(self._response_counts,
+                                     self._response_count_metrics,
+                                     self._http_response_metric_name))
+            if self._response_bytes is not None:
+                points.extend(
+                    self._counter_points(
+                        self._response_bytes, self._response_bytes_metrics,
+                        self._http_response_bytes_metric_name))
+        self._has_delta = False
+        if self._spool is not None and not self._spool.empty():
+            for point in points:
+                self._deferred[(point[1],
+                                tuple(sorted(point[2].items())))] = point
+            self._replay_spool()
+            if not self._spool.empty():
+                return
+            points = self._deferred.values()
+            self._deferred = collections.OrderedDict()
+        if not self._write_points(points):
+            # Retry with the latest counts on the next commit.
+            self._has_delta = True
+            self._sampling_rate_written = None
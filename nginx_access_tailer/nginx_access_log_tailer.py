@@ -5,54 +5,152 @@ import os
 import re
 import time
 
+from nginx_access_tailer.profiling import StageTimer
+
+
+def _warn_rotation_check_args(rotation_check_idle_time_s,
+                              rotation_check_period_s):
+    """Log a warning if deprecated rotation check arguments are given."""
+    if (rotation_check_idle_time_s is not None or
+            rotation_check_period_s is not None):
+        logging.warning('rotation_check_idle_time_s and '
+                        'rotation_check_period_s are deprecated and ignored')
+
 
 class SimpleTailer(object):
-    """A simple file tailer supporting basic log rotation detection."""
+    """A simple file tailer supporting log rotation and truncation detection.
+
+    Both rename-style rotation (the log is moved aside and a new file created
+    at the original path) and copytruncate-style rotation (the log is copied
+    aside and truncated in place) are detected on every call to get_lines, by
+    way of cheap fstat / stat comparisons against the open handle. Truncation
+    is detected by the file shrinking since it was last checked, so it is
+    noticed even if the file has since grown past our read offset.
+
+    On rename-style rotation, the old file is read to EOF before switching to
+    the new one, so lines written after our last read are not lost. On
+    truncation, reading resumes from the start of the file; any lines written
+    between our last read and the truncation are only present in the copy and
+    cannot be recovered.
+
+    If max_read_bytes is set, each call to get_lines reads roughly that many
+    bytes at most, leaving any remainder in the file (see backlog_bytes).
+    Rename-style rotation is then only acted on once the old file has been
+    read up to its current size.
+    """
 
     def __init__(self,
                  filename,
-                 rotation_check_idle_time_s=30,
-                 rotation_check_period_s=10):
+                 rotation_check_idle_time_s=None,
+                 rotation_check_period_s=None,
+                 max_read_bytes=None):
         """Create the tailer.
 
         Args:
           filename: filename of the log to read from.
-          rotation_check_idle_time_s: number of seconds of idle time (no new
-            log lines) before starting rotation checks (seconds; default: 30)
-          rotation_check_period_s: period between log rotation checks (seconds;
-            default: 10)
+          rotation_check_idle_time_s: deprecated and ignored (rotation is
+            checked on every call to get_lines).
+          rotation_check_period_s: deprecated and ignored.
+          max_read_bytes: approximate maximum number of bytes to read per call
+            to get_lines (optional; default: read to EOF).
         """
+        _warn_rotation_check_args(rotation_check_idle_time_s,
+                                  rotation_check_period_s)
         self._filename = filename
+        self._max_read_bytes = max_read_bytes or 0
         self._flog = None
-        self._flog_ino = None
-        self._last_read_time = None
-        self._last_rotation_check_time = None
-        self._rotation_check_idle_time_s = rotation_check_idle_time_s
-        self._rotation_check_period_s = rotation_check_period_s
-
-    def _maybe_rotate(self):
-        """Periodically check for log rotation by comparing inode numbers."""
-        # If we've never performed a full rotation check, do so.
-        now = time.time()
-        if self._last_rotation_check_time is not None:
-            # Otherwise, only do so if a full rotation check period has passed.
-            next_check_time = (
-                self._last_rotation_check_time + self._rotation_check_period_s)
-            if now < next_check_time:
-                return
-        self._last_rotation_check_time = now
+        self._flog_id = None
+        self._last_size = 0
+        self._partial = ''
+
+    def _open(self):
+        """Open the log file, recording its (device, inode) identity.
+
+        Returns:
+          True if the log file was opened, False otherwise.
+        """
         try:
-            ino = os.stat(self._filename).st_ino
+            self._flog = open(self._filename, 'r')
+        except IOError as err:
+            logging.warning('Could not open log file: %s', err)
+            return False
+        stat = os.fstat(self._flog.fileno())
+        self._flog_id = (stat.st_dev, stat.st_ino)
+        self._last_size = 0
+        self._partial = ''
+        return True
+
+    def _check_truncation(self):
+        """Rewind the log file if it was truncated since the last check."""
+        size = os.fstat(self._flog.fileno()).st_size
+        # Truncated in place (e.g. logrotate copytruncate): the file is now
+        # shorter than it was, or than our read offset.
+        truncated = size < max(self._last_size, self._flog.tell())
+        self._last_size = size
+        if truncated:
+            logging.info('Detected file truncation: rewinding %s',
+                         self._filename)
+            self._flog.seek(0)
+            self._partial = ''
+
+    def _read_lines(self, final=False):
+        """Read complete lines from the open log file.
+
+        A trailing partial line (one not yet terminated by a newline, e.g.
+        because the writer is mid-write) is held back and prepended to the
+        next read.
+
+        Args:
+          final: if True, this is the last read from this file, and any
+            trailing partial line is returned as-is.
+
+        Returns:
+          List of lines read (possibly empty).
+        """
+        if final:
+            lines = self._flog.readlines()
+        else:
+            lines = self._flog.readlines(self._max_read_bytes)
+        if self._partial:
+            if lines:
+                lines[0] = self._partial + lines[0]
+            else:
+                lines = [self._partial]
+            self._partial = ''
+        if lines and not lines[-1].endswith('\n') and not final:
+            self._partial = lines.pop()
+        return lines
+
+    def _maybe_rotate(self, lines):
+        """Check for rotation, reading any resulting lines.
+
+        Args:
+          lines: list of lines read so far in this pass; any lines read as a
+            result of rotation handling are appended.
+        """
+        size = os.fstat(self._flog.fileno()).st_size
+        self._last_size = max(self._last_size, size)
+        if size < self._flog.tell():
+            # Truncated since our read; handled on the next pass.
+            return
+        if size > self._flog.tell():
+            # Not yet caught up with the current file.
+            return
+        try:
+            stat = os.stat(self._filename)
         except OSError:
             # It's possible that the log writer has not created the new log
-            # file yet
+            # file yet; keep reading from the old one in the meantime.
             return
-        if ino != self._flog_ino:
+        if (stat.st_dev, stat.st_ino) != self._flog_id:
             logging.info('Detected file rotation: reopening %s',
                          self._filename)
+            # Drain anything written to the old file since our last read.
+            lines.extend(self._read_lines(final=True))
             self._flog.close()
-            self._flog = open(self._filename, 'r')
-            self._flog_ino = os.fstat(self._flog.fileno()).st_ino
+            self._flog = None
+            if self._open():
+                lines.extend(self._read_lines())
 
     def get_lines(self):
         """Returns the latest lines in the log file (possibly none).
@@ -62,58 +160,173 @@ class SimpleTailer(object):
           written or None if the log file cannot be opened.
         """
         if self._flog is None:
-            try:
-                self._flog = open(self._filename, 'r')
-                self._flog_ino = os.fstat(self._flog.fileno()).st_ino
-            except IOError as err:
-                logging.warning('Could not open log file: %s', err)
+            if not self._open():
                 return None
-        lines = self._flog.readlines()
-        if lines:
-            self._last_read_time = time.time()
-        else:
-            if self._last_read_time is None:
-                # We've never read anything: Start rotation checks.
-                self._maybe_rotate()
-            else:
-                # We've read data in the past: Enter rotation checks only after
-                # the idle timeout.
-                idle_time = time.time() - self._last_read_time
-                if idle_time > self._rotation_check_idle_time_s:
-                    self._maybe_rotate()
+        self._check_truncation()
+        lines = self._read_lines()
+        self._maybe_rotate(lines)
         return lines
 
+    def backlog_bytes(self):
+        """Returns the number of bytes in the log file not yet read."""
+        if self._flog is None:
+            return 0
+        size = os.fstat(self._flog.fileno()).st_size
+        return max(0, size - self._flog.tell())
+
+
+class PollingScheduler(object):
+    """Chooses the time between log tail checks based on observed load.
+
+    The line arrival rate is tracked as an exponentially weighted moving
+    average, and the polling period chosen such that each poll is expected to
+    pick up roughly target_batch_lines lines, bounded to [min_period_s,
+    max_period_s]. If a single poll returns at least target_batch_lines lines
+    (i.e. a backlog has built up), the minimum period is used until it clears.
+    An idle log decays the rate estimate, backing off toward the maximum.
+    """
+
+    def __init__(self,
+                 min_period_s,
+                 max_period_s,
+                 target_batch_lines=1000,
+                 smoothing=0.3):
+        """Create the scheduler.
+
+        Args:
+          min_period_s: minimum time between tail checks (seconds).
+          max_period_s: maximum time between tail checks (seconds).
+          target_batch_lines: desired number of lines per tail check
+            (default: 1000).
+          smoothing: weight given to the latest rate observation in the moving
+            average (default: 0.3).
+        """
+        if min_period_s > max_period_s:
+            raise ValueError('min_period_s must not exceed max_period_s')
+        self._min_period_s = min_period_s
+        self._max_period_s = max_period_s
+        self._target_batch_lines = target_batch_lines
+        self._smoothing = smoothing
+        self._rate = 0.0
+        self._last_time = None
+        self._period_s = max_period_s
+
+    def rate(self):
+        """Returns the current line arrival rate estimate (lines / second)."""
+        return self._rate
+
+    def period(self):
+        """Returns the current polling period (seconds)."""
+        return self._period_s
+
+    def update(self, num_lines, now):
+        """Update the rate estimate and polling period after a tail check.
+
+        Args:
+          num_lines: number of lines returned by the tail check.
+          now: time at which the tail check was performed.
+
+        Returns:
+          The new polling period (seconds).
+        """
+        if self._last_time is not None and now > self._last_time:
+            observed = num_lines / (now - self._last_time)
+            self._rate += self._smoothing * (observed - self._rate)
+        self._last_time = now
+        if num_lines >= self._target_batch_lines:
+            period_s = self._min_period_s
+        elif self._rate > 0:
+            period_s = self._target_batch_lines / self._rate
+        else:
+            period_s = self._max_period_s
+        self._period_s = min(self._max_period_s,
+                             max(self._min_period_s, period_s))
+        return self._period_s
+
 
 class NginxAccessLogTailer(object):
-    """Tails the provided access log, passing parsed log lines to the consumer."""
+    """Tails the provided access log, passing parsed log lines to the consumer.
+
+    If the tailer falls behind the log by more than max_lag_bytes (unread
+    bytes remaining after a tail check) or max_lag_s (time since it was last
+    caught up), it enters overload mode: only every overload_sample_every'th
+    line is parsed and recorded, with a correspondingly scaled weight. Exact
+    counting resumes once the tailer has caught up with the log.
+    """
 
     # Partial regex for a full nginx access log line
     NGINX_ACCESS_LOG_RE = (
         r'(?P<ipaddress>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}) - - '
         r'\[(?P<datetime>\d{2}\/[A-Z,a-z]{3}\/\d{4}:\d{2}:\d{2}:\d{2} '
-        r'(\+|\-)\d{4})\] ((\"(GET|POST) )(?P<url>.+) (HTTP\/1\.1")) '
-        r'(?P<statuscode>\d{3}) .*')
+        r'(\+|\-)\d{4})\] '
+        r'"(?P<method>GET|POST|HEAD|PUT|DELETE|PATCH|OPTIONS) (?P<url>.+) '
+        r'(?P<httpversion>HTTP\/\d(\.\d)?)" '
+        r'(?P<statuscode>\d{3}) (?P<bytessent>\d+).*')
+
+    # As above, also capturing $upstream_addr from a trailing
+    # upstream="$upstream_addr" field (e.g. appended to the combined format),
+    # if present. Slower to match, so only used when needed.
+    NGINX_ACCESS_LOG_UPSTREAM_RE = (
+        NGINX_ACCESS_LOG_RE[:-len('.*')] +
+        r'(?:.* upstream="(?P<upstream>[^"]*)")?.*')
 
-    def __init__(self, log_file, consumer, rotation_check_idle_time_s,
-                 rotation_check_period_s):
+    def __init__(self,
+                 log_file,
+                 consumer,
+                 rotation_check_idle_time_s=None,
+                 rotation_check_period_s=None,
+                 max_read_bytes=None,
+                 max_lag_bytes=None,
+                 max_lag_s=None,
+                 overload_sample_every=10,
+                 source=None,
+                 log_regex=None):
         """Initialize the tailer.
 
         Args:
-          log_file: path to the nginx access log
-          consumer: the log consumer object, exporting both a record method,
-            which takes a parsed access log line, and a commit method, which
-            writes metrics to stackdriver.
-          rotation_check_idle_time_s: min log idle time before starting
-            rotation checks (see SimpleTailer).
-          rotation_check_period_s: min period between rotation checks (see
+          log_file: path to the nginx access log (unused if source is given)
+          consumer: the log consumer object, exporting a record method, which
+            takes a parsed access log line and an optional weight, a
+            set_sampling_rate method, and a commit method, which writes
+            metrics to stackdriver.
+          rotation_check_idle_time_s: deprecated and ignored (see
             SimpleTailer).
+          rotation_check_period_s: deprecated and ignored.
+          max_read_bytes: approximate maximum number of bytes to read per tail
+            check (optional; see SimpleTailer).
+          max_lag_bytes: unread byte backlog above which overload mode is
+            entered (optional; default: no limit).
+          max_lag_s: time behind the log above which overload mode is entered
+            (optional; default: no limit).
+          overload_sample_every: sample one in this many lines while in
+            overload mode (default: 10).
+          source: object providing get_lines and backlog_bytes methods like
+            those of SimpleTailer, from which to read log lines instead of
+            tailing log_file (optional; e.g. a SyslogReceiver). If it also
+            provides a wait(timeout_s) method, returning early once input is
+            available, watch() uses it rather than sleeping out the full
+            polling period.
+          log_regex: regex with which to parse log lines, with named groups
+            as in NGINX_ACCESS_LOG_RE (default: NGINX_ACCESS_LOG_RE).
         """
-        self._tailer = SimpleTailer(
-            log_file,
-            rotation_check_idle_time_s=rotation_check_idle_time_s,
-            rotation_check_period_s=rotation_check_period_s)
+        _warn_rotation_check_args(rotation_check_idle_time_s,
+                                  rotation_check_period_s)
+        if source is None:
+            source = SimpleTailer(log_file, max_read_bytes=max_read_bytes)
+        self._tailer = source
         self._consumer = consumer
-        self._re_parser = re.compile(self.NGINX_ACCESS_LOG_RE)
+        self._re_parser = re.compile(log_regex or self.NGINX_ACCESS_LOG_RE)
+        self._max_lag_bytes = max_lag_bytes
+        self._max_lag_s = max_lag_s
+        self._overload_sample_every = overload_sample_every
+        self._sample_every = 1
+        self._sample_index = 0
+        self._caught_up_time = None
+        self._stage_timer = StageTimer()
+
+    def stage_timer(self):
+        """Returns the StageTimer accumulating time spent in watch()."""
+        return self._stage_timer
 
     def _parse_nginx_access_log(self, log_line):
         """Parse an nginx access log line.
@@ -123,30 +336,154 @@ class NginxAccessLogTailer(object):
 
         Returns:
           dict containing a mapping from matched groups to substrings; only the
-          datetime and statuscode fields are assumed present.
+          datetime and statuscode fields are required by the consumer, with
+          method and httpversion used by the corresponding dimensions and
+          bytessent by the bytes sent metric.
         """
         match = self._re_parser.match(log_line)
         if match:
             return match.groupdict()
         return None
 
-    def watch(self, polling_period_s):
+    def _update_overload(self, now):
+        """Enter or leave overload mode based on how far behind we are.
+
+        Args:
+          now: time of the current tail check.
+
+        Returns:
+          The number of unread bytes remaining in the log.
+        """
+        lag_bytes = self._tailer.backlog_bytes()
+        if lag_bytes == 0 or self._caught_up_time is None:
+            self._caught_up_time = now
+        lag_s = now - self._caught_up_time
+        if self._sample_every == 1:
+            if ((self._max_lag_bytes is not None and
+                 lag_bytes > self._max_lag_bytes) or
+                    (self._max_lag_s is not None and lag_s > self._max_lag_s)):
+                logging.warning(
+                    'Entering overload mode (lag: %d bytes, %.1f s): '
+                    'sampling 1 in %d lines', lag_bytes, lag_s,
+                    self._overload_sample_every)
+                self._sample_every = self._overload_sample_every
+                self._sample_index = 0
+                self._consumer.set_sampling_rate(1.0 / self._sample_every)
+        elif lag_bytes == 0:
+            logging.info('Leaving overload mode: caught up with log')
+            self._sample_every = 1
+            self._consumer.set_sampling_rate(1.0)
+        return lag_bytes
+
+    def _parse_lines(self, lines):
+        """Parse the provided log lines, sampling if overloaded.
+
+        Args:
+          lines: list of log lines from the access log
+
+        Returns:
+          List of parsed lines (see _parse_nginx_access_log).
+        """
+        results = []
+        sample_every = self._sample_every
+        for line in lines:
+            if sample_every > 1:
+                self._sample_index += 1
+                if self._sample_index < sample_every:
+                    continue
+                self._sample_index = 0
+            result = self._parse_nginx_access_log(line)
+            if result:
+                results.append(result)
+            else:
+                logging.warning('Could not parse log line: "%s"', line)
+        return results
+
+    def _record_results(self, results):
+        """Record parsed log lines, weighted if sampled.
+
+        Args:
+          results: list of parsed log lines from _parse_lines
+        """
+        sample_every = self._sample_every
+        if sample_every > 1:
+            for result in results:
+                self._consumer.record(result, weight=sample_every)
+        else:
+            for result in results:
+                self._consumer.record(result)
+
+    def watch(self,
+              polling_period_s,
+              max_polling_period_s=None,
+              commit_period_s=None,
+              target_batch_lines=1000,
+              profiler=None):
         """Watch the configured log file in perpetuity.
 
+        Tail checks are scheduled adaptively between polling_period_s and
+        max_polling_period_s (see PollingScheduler), or immediately if unread
+        backlog remains, while the consumer is committed on its own fixed
+        cadence. Sources with a wait method are read again as soon as input
+        arrives after polling_period_s. Time spent in each stage is
+        accumulated in stage_timer().
+
         Args:
-          polling_period_s: number of seconds between tail checks (optional)
+          polling_period_s: minimum number of seconds between tail checks.
+          max_polling_period_s: maximum number of seconds between tail checks
+            (optional; default: polling_period_s, i.e. a fixed period).
+          commit_period_s: number of seconds between consumer commits
+            (optional; default: polling_period_s).
+          target_batch_lines: desired number of lines per tail check (see
+            PollingScheduler).
+          profiler: Profiler whose profiling windows are ended from the loop
+            (optional).
         """
+        if max_polling_period_s is None:
+            max_polling_period_s = polling_period_s
+        if commit_period_s is None:
+            commit_period_s = polling_period_s
+        scheduler = PollingScheduler(
+            polling_period_s,
+            max_polling_period_s,
+            target_batch_lines=target_batch_lines)
+        timer = self._stage_timer
+        next_commit_time = None
         while True:
             t_start = time.time()
             lines = self._tailer.get_lines()
             if lines is None:
                 logging.warning('Could not open log file.')
-            else:
-                for line in lines:
-                    result = self._parse_nginx_access_log(line)
-                    if result:
-                        self._consumer.record(result)
-                    else:
-                        logging.warning('Could not parse log line: "%s"', line)
+                lines = []
+            lag_bytes = self._update_overload(t_start)
+            t_read = time.time()
+            timer.add('read', t_read - t_start)
+            results = self._parse_lines(lines)
+            t_parse = time.time()
+            timer.add('parse', t_parse - t_read)
+            self._record_results(results)
+            timer.add('record', time.time() - t_parse)
+            scheduler.update(len(lines), t_start)
+            if next_commit_time is None or t_start >= next_commit_time:
+                t_commit = time.time()
                 self._consumer.commit()
-            time.sleep(max(0, polling_period_s - time.time() + t_start))
+                timer.add('commit', time.time() - t_commit)
+                next_commit_time = t_start + commit_period_s
+            if profiler is not None:
+                profiler.maybe_stop(t_start)
+            if lag_bytes > 0:
+                next_poll_time = t_start
+            else:
+                next_poll_time = t_start + scheduler.period()
+            deadline = min(next_poll_time, next_commit_time)
+            wait = getattr(self._tailer, 'wait', None)
+            if wait is None:
+                time.sleep(max(0, deadline - time.time()))
+            else:
+                # Batch input for at least the minimum period, then read as
+                # soon as more arrives.
+                time.sleep(
+                    max(0,
+                        min(t_start + polling_period_s, deadline) -
+                        time.time()))
+                wait(max(0, deadline - time.time()))
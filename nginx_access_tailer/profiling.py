@@ -0,0 +1,198 @@
+"""Built-in profiling and per-stage timing helpers."""
+
+import cProfile
+import errno
+import logging
+import marshal
+import os
+import signal
+import time
+
+
+def _create_private(path):
+    """Returns a new file at path, open for writing and private to the user.
+
+    The file must not already exist (even as a symlink); its directory is
+    created, also private, if missing.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    fd = os.open(path,
+                 os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+    return os.fdopen(fd, 'wb')
+
+
+class StageTimer(object):
+    """Cumulative wall time spent in each stage of the watch loop.
+
+    Stages are read (tailing the log), parse (access log regex), record
+    (timestamp parsing and counting in the consumer) and commit (writing to
+    the monitoring API).
+    """
+
+    STAGES = ('read', 'parse', 'record', 'commit')
+
+    def __init__(self):
+        self._totals = None
+        self._start_time = None
+        self.reset()
+
+    def reset(self):
+        """Zero all stage totals."""
+        self._totals = dict.fromkeys(self.STAGES, 0.0)
+        self._start_time = time.time()
+
+    def add(self, stage, seconds):
+        """Add time spent in the given stage."""
+        self._totals[stage] += seconds
+
+    def totals(self):
+        """Returns a dict of stage name => total seconds since reset."""
+        return dict(self._totals)
+
+    def summary(self):
+        """Returns a one-line summary of stage totals since reset."""
+        elapsed = max(time.time() - self._start_time, 1e-9)
+        return ', '.join('%s: %.3f s (%.1f%%)' %
+                         (stage, self._totals[stage],
+                          100.0 * self._totals[stage] / elapsed)
+                         for stage in self.STAGES) + ' over %.1f s' % elapsed
+
+
+class Profiler(object):
+    """Collects a CPU profile of the process for a bounded window.
+
+    Two modes are supported: 'cprofile', which writes cProfile (pstats)
+    output, and 'sample', which samples the main thread's stack every
+    sample_interval_s of CPU time (via SIGPROF) and writes collapsed stacks
+    (one 'frame;frame;... count' line per distinct stack, as consumed by
+    flamegraph tools) at much lower overhead.
+
+    A window is started by start (e.g. from a signal handler), and ended by
+    the first call to maybe_stop after duration_s has passed, at which point
+    the profile is written to '<output_prefix>.<start time>'. The file is
+    created exclusively (never following or replacing an existing path),
+    with its directory created if needed, both private to the user. If a
+    StageTimer is provided, it is reset at the start of each window and its
+    summary logged at the end.
+    """
+
+    MODES = ('cprofile', 'sample')
+
+    def __init__(self,
+                 output_prefix,
+                 duration_s=60.0,
+                 mode='cprofile',
+                 sample_interval_s=0.005,
+                 stage_timer=None):
+        """Create the profiler.
+
+        Args:
+          output_prefix: path prefix of profile output files.
+          duration_s: length of each profiling window (seconds; default: 60).
+          mode: 'cprofile' or 'sample' (default: 'cprofile').
+          sample_interval_s: CPU time between stack samples in sample mode
+            (seconds; default: 0.005).
+          stage_timer: StageTimer to report over each window (optional).
+        """
+        if mode not in self.MODES:
+            raise ValueError('Unknown profiling mode: %s' % mode)
+        self._output_prefix = output_prefix
+        self._duration_s = duration_s
+        self._mode = mode
+        self._sample_interval_s = sample_interval_s
+        self._stage_timer = stage_timer
+        self._start_time = None
+        self._profile = None
+        self._samples = None
+        self._prev_handler = None
+
+    def active(self):
+        """Returns True if a profiling window is in progress."""
+        return self._start_time is not None
+
+    def start(self):
+        """Start a profiling window, unless one is already in progress."""
+        if self.active():
+            return
+        logging.info('Starting %s profile for %.1f s', self._mode,
+                     self._duration_s)
+        self._start_time = time.time()
+        if self._stage_timer is not None:
+            self._stage_timer.reset()
+        if self._mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._samples = {}
+            self._prev_handler = signal.signal(signal.SIGPROF, self._sample)
+            # Restart system calls (e.g. log reads) interrupted by sampling.
+            signal.siginterrupt(signal.SIGPROF, False)
+            signal.setitimer(signal.ITIMER_PROF, self._sample_interval_s,
+                             self._sample_interval_s)
+
+    def _sample(self, signum, frame):
+        """SIGPROF handler: record the interrupted stack."""
+        _ = signum
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s:%s:%d' % (os.path.basename(code.co_filename),
+                                       code.co_name, code.co_firstlineno))
+            frame = frame.f_back
+        key = ';'.join(reversed(stack))
+        self._samples[key] = self._samples.get(key, 0) + 1
+
+    def maybe_stop(self, now):
+        """End the profiling window if it has run for duration_s.
+
+        Args:
+          now: the current time.
+
+        Returns:
+          The path the profile was written to, or None if not stopped.
+        """
+        if not self.active() or now - self._start_time < self._duration_s:
+            return None
+        return self.stop()
+
+    def stop(self):
+        """End the profiling window and write the profile.
+
+        Returns:
+          The path the profile was written to, or None if not active.
+        """
+        if not self.active():
+            return None
+        path = '%s.%d' % (self._output_prefix, int(self._start_time))
+        profile = self._profile
+        samples = self._samples
+        if self._mode == 'cprofile':
+            profile.disable()
+            self._profile = None
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self._prev_handler)
+            self._samples = None
+        self._start_time = None
+        try:
+            with _create_private(path) as fout:
+                if profile is not None:
+                    # As cProfile.Profile.dump_stats, but to our own file.
+                    profile.create_stats()
+                    marshal.dump(profile.stats, fout)
+                else:
+                    for stack, count in sorted(samples.iteritems()):
+                        fout.write('%s %d\n' % (stack, count))
+        except (IOError, OSError) as err:
+            logging.error('Could not write %s profile: %s', self._mode, err)
+            return None
+        logging.info('Wrote %s profile to %s', self._mode, path)
+        if self._stage_timer is not None:
+            logging.info('Stage times: %s', self._stage_timer.summary())
+        return path
@@ -0,0 +1,440 @@
+"""Fleet-level aggregation relay for exported metrics.
+
+Rather than each host writing its own points to the monitoring API, tailers
+may use a RelayClient in place of the monitoring client, which pushes compact
+binary counter deltas over a local TCP or unix socket to a RelayAggregator.
+The aggregator merges them per resource and label set, and writes large
+batches of time series to the monitoring API on a fixed cadence.
+
+Wire format: a stream of frames, each a 4-byte big-endian payload length
+followed by a payload consisting of one record:
+
+  'D' <series id: uint32> <length: uint16> <JSON series definition>
+  'C' <series id: uint32> <delta: int64>
+  'G' <series id: uint32> <value: float64>
+
+Series ids are assigned by the sender, per connection, and must be defined
+(with the resource and metric type and labels) before use.
+
+Delivery is at-most-once: there are no acknowledgements, so deltas sent on a
+connection the aggregator has already closed, or received by an aggregator
+that exits before flushing them, are lost.
+"""
+
+import errno
+import json
+import logging
+import os
+import select
+import socket
+import stat
+import struct
+import time
+from datetime import datetime
+
+_FRAME_HEADER = struct.Struct('!I')
+_DEFINE = struct.Struct('!cIH')
+_COUNTER = struct.Struct('!cIq')
+_GAUGE = struct.Struct('!cId')
+_RECORDS = {'D': _DEFINE, 'C': _COUNTER, 'G': _GAUGE}
+
+
+def _open_socket(address):
+    """Returns an unconnected stream socket and its address for address.
+
+    Args:
+      address: either 'unix:<path>' or '<host>:<port>'.
+    """
+    if address.startswith('unix:'):
+        return (socket.socket(socket.AF_UNIX, socket.SOCK_STREAM),
+                address[len('unix:'):])
+    host, port = address.rsplit(':', 1)
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    return (socket.socket(family, socket.SOCK_STREAM), (host.strip('[]'),
+                                                         int(port)))
+
+
+def _is_labels(labels):
+    """Returns True if labels is a dict of string label names and values."""
+    return isinstance(labels, dict) and all(
+        isinstance(name, basestring) and isinstance(value, basestring)
+        for name, value in labels.items())
+
+
+def _parse_definition(definition):
+    """Returns the dict for a JSON series definition.
+
+    Raises:
+      ValueError: if definition is not a valid series definition.
+    """
+    spec = json.loads(definition)
+    if not (isinstance(spec, dict) and
+            isinstance(spec.get('cumulative'), bool) and all(
+                isinstance(spec.get(part), dict) and
+                isinstance(spec[part].get('type'), basestring) and
+                _is_labels(spec[part].get('labels'))
+                for part in ('resource', 'metric'))):
+        raise ValueError('Invalid relay series definition: %r' % definition)
+    return spec
+
+
+class RelayResource(object):
+    """Stand-in for a monitored resource object, as sent to the aggregator."""
+
+    def __init__(self, type_, labels):
+        self.type = type_
+        self.labels = labels
+
+
+class RelayMetric(object):
+    """Stand-in for a metric object, as sent to the aggregator."""
+
+    def __init__(self, type_, labels):
+        self.type = type_
+        self.labels = labels
+
+
+class RelayClient(object):
+    """Drop-in replacement for the monitoring client, relaying to an aggregator.
+
+    Supports the subset of the monitoring client used by
+    NginxAccessLogConsumer: resource, metric and write_point. Cumulative
+    points (those with a start_time) are sent as deltas from the last value
+    successfully sent; gauge points are sent as-is.
+
+    If the aggregator cannot be reached, points are not sent (and deltas
+    accumulate until they are), with reconnection attempted at most every
+    reconnect_period_s. A send is taken as delivered once it succeeds
+    locally, so deltas written just before the connection is found to be
+    closed are not resent (see the module docstring).
+    """
+
+    def __init__(self, address, reconnect_period_s=10.0, timeout_s=5.0):
+        """Create the client; the connection is made on first use.
+
+        Args:
+          address: aggregator address, either 'unix:<path>' or
+            '<host>:<port>'.
+          reconnect_period_s: minimum time between connection attempts
+            (seconds; default: 10).
+          timeout_s: timeout for connecting and sending (seconds; default: 5).
+        """
+        self._address = address
+        self._reconnect_period_s = reconnect_period_s
+        self._timeout_s = timeout_s
+        self._sock = None
+        self._last_connect_time = None
+        self._series_ids = {}
+        self._sent = {}
+
+    def resource(self, type_, labels):
+        """Returns a resource object for use with write_point."""
+        return RelayResource(type_, labels)
+
+    def metric(self, type_, labels):
+        """Returns a metric object for use with write_point."""
+        return RelayMetric(type_, labels)
+
+    def close(self):
+        """Close the connection to the aggregator, if any."""
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        # Series ids are per connection.
+        self._series_ids = {}
+
+    def _connect(self):
+        """Connect to the aggregator, returning True on success."""
+        now = time.time()
+        if (self._last_connect_time is not None and
+                now - self._last_connect_time < self._reconnect_period_s):
+            return False
+        self._last_connect_time = now
+        sock, sock_address = _open_socket(self._address)
+        sock.settimeout(self._timeout_s)
+        try:
+            sock.connect(sock_address)
+        except socket.error as err:
+            logging.warning('Could not connect to relay aggregator %s: %s',
+                            self._address, err)
+            sock.close()
+            return False
+        logging.info('Connected to relay aggregator %s', self._address)
+        self._sock = sock
+        return True
+
+    def _series_key(self, metric, resource):
+        """Returns a hashable key identifying a series."""
+        return (resource.type, tuple(sorted(resource.labels.items())),
+                metric.type, tuple(sorted(metric.labels.items())))
+
+    def write_point(self, metric, resource, value, start_time=None):
+        """Relay a point to the aggregator.
+
+        Args:
+          metric: metric object from metric().
+          resource: resource object from resource().
+          value: point value; cumulative if start_time is given, else a gauge.
+          start_time: start time of a cumulative point (optional).
+        """
+        if self._sock is None and not self._connect():
+            return
+        key = self._series_key(metric, resource)
+        records = []
+        series_id = self._series_ids.get(key)
+        if series_id is None:
+            series_id = len(self._series_ids)
+            definition = json.dumps({
+                'resource': {
+                    'type': resource.type,
+                    'labels': resource.labels
+                },
+                'metric': {
+                    'type': metric.type,
+                    'labels': metric.labels
+                },
+                'cumulative': start_time is not None,
+            })
+            records.append(
+                _DEFINE.pack('D', series_id, len(definition)) + definition)
+        if start_time is not None:
+            records.append(
+                _COUNTER.pack('C', series_id, value - self._sent.get(key, 0)))
+        else:
+            records.append(_GAUGE.pack('G', series_id, value))
+        try:
+            self._sock.sendall(''.join(
+                _FRAME_HEADER.pack(len(record)) + record
+                for record in records))
+        except socket.error as err:
+            logging.warning('Lost connection to relay aggregator %s: %s',
+                            self._address, err)
+            self.close()
+            return
+        self._series_ids[key] = series_id
+        if start_time is not None:
+            self._sent[key] = value
+
+
+class _Series(object):
+    """Merged state of a series in the aggregator."""
+
+    __slots__ = ('resource', 'metric', 'cumulative', 'value')
+
+    def __init__(self, resource, metric, cumulative):
+        self.resource = resource
+        self.metric = metric
+        self.cumulative = cumulative
+        self.value = 0
+
+
+class RelayAggregator(object):
+    """Receives relayed points from tailers and writes them in batches.
+
+    Counter deltas are summed, and gauge values replaced, per resource and
+    label set. Every flush_period_s, all series updated since the last flush
+    are written to the monitoring API, in batches of up to max_batch time
+    series per request. Cumulative series are written relative to the
+    aggregator's start time. Series that fail to be written are retried,
+    with their latest values, on the next flush.
+    """
+
+    def __init__(self, client, address, flush_period_s=60.0, max_batch=200):
+        """Create the aggregator, binding its listening socket.
+
+        Args:
+          client: cloud monitoring client.
+          address: address to listen on, either 'unix:<path>' or
+            '<host>:<port>'.
+          flush_period_s: time between writes to the monitoring API (seconds;
+            default: 60).
+          max_batch: maximum number of time series per write (default: 200).
+        """
+        self._client = client
+        self._flush_period_s = flush_period_s
+        self._max_batch = max_batch
+        self._start_time = datetime.utcnow()
+        self._unix_path = None
+        self._listener, sock_address = _open_socket(address)
+        if address.startswith('unix:'):
+            self._unix_path = sock_address
+            self._remove_socket_file()
+        else:
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
+                                      1)
+        self._listener.bind(sock_address)
+        self._listener.listen(128)
+        self._listener.setblocking(False)
+        # Per connection: [receive buffer, {series id => _Series}]
+        self._connections = {}
+        self._series = {}
+        self._dirty = set()
+        self._resources = {}
+        self._metrics = {}
+        self._next_flush_time = time.time() + flush_period_s
+        logging.info('Listening for relayed points on %s', address)
+
+    def address(self):
+        """Returns the bound socket address."""
+        return self._listener.getsockname()
+
+    def close(self):
+        """Close all sockets (removing the listener, if a unix socket)."""
+        for conn in self._connections.keys():
+            conn.close()
+        self._connections = {}
+        self._listener.close()
+        if self._unix_path is not None:
+            self._remove_socket_file()
+
+    def _remove_socket_file(self):
+        """Remove a (stale) unix socket at our path, but not other files."""
+        try:
+            mode = os.lstat(self._unix_path).st_mode
+        except OSError:
+            return
+        if stat.S_ISSOCK(mode):
+            os.unlink(self._unix_path)
+
+    def _accept(self):
+        """Accept pending connections."""
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            conn.setblocking(False)
+            self._connections[conn] = [b'', {}]
+
+    def _series_for(self, definition):
+        """Returns the merged _Series for a JSON series definition."""
+        spec = _parse_definition(definition)
+        resource = spec['resource']
+        metric = spec['metric']
+        key = (resource['type'], tuple(sorted(resource['labels'].items())),
+               metric['type'], tuple(sorted(metric['labels'].items())))
+        series = self._series.get(key)
+        if series is None:
+            resource_key = key[:2]
+            if resource_key not in self._resources:
+                self._resources[resource_key] = self._client.resource(
+                    resource['type'], labels=resource['labels'])
+            metric_key = key[2:]
+            if metric_key not in self._metrics:
+                self._metrics[metric_key] = self._client.metric(
+                    type_=metric['type'], labels=metric['labels'])
+            series = _Series(self._resources[resource_key],
+                             self._metrics[metric_key], spec['cumulative'])
+            self._series[key] = series
+        return series
+
+    def _process(self, state):
+        """Decode and merge all complete frames in a connection's buffer.
+
+        Raises:
+          KeyError, ValueError or struct.error: if the input is malformed.
+        """
+        data, series_by_id = state
+        offset = 0
+        while len(data) - offset >= _FRAME_HEADER.size:
+            (length,) = _FRAME_HEADER.unpack_from(data, offset)
+            end = offset + _FRAME_HEADER.size + length
+            if len(data) < end:
+                break
+            start = offset + _FRAME_HEADER.size
+            if length < 1:
+                raise ValueError('Empty relay frame')
+            kind = data[start]
+            record = _RECORDS.get(kind)
+            if record is None:
+                raise ValueError('Unknown relay record type: %r' % kind)
+            if length < record.size:
+                raise ValueError('Truncated relay record: %r' % kind)
+            if kind == 'D':
+                _, series_id, def_length = _DEFINE.unpack_from(data, start)
+                def_start = start + _DEFINE.size
+                if def_start + def_length > end:
+                    raise ValueError('Truncated relay series definition')
+                series_by_id[series_id] = self._series_for(
+                    data[def_start:def_start + def_length])
+            elif kind == 'C':
+                _, series_id, delta = _COUNTER.unpack_from(data, start)
+                series = series_by_id[series_id]
+                series.value += delta
+                self._dirty.add(series)
+            else:
+                _, series_id, value = _GAUGE.unpack_from(data, start)
+                series = series_by_id[series_id]
+                series.value = value
+                self._dirty.add(series)
+            offset = end
+        state[0] = data[offset:]
+
+    def _receive(self, conn):
+        """Read from a connection, closing it on EOF or error."""
+        state = self._connections[conn]
+        try:
+            chunk = conn.recv(1 << 16)
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            chunk = b''
+        if chunk:
+            state[0] += chunk
+            try:
+                self._process(state)
+                return
+            except (KeyError, ValueError, struct.error) as err:
+                logging.warning('Dropping relay connection: %s', err)
+        conn.close()
+        del self._connections[conn]
+
+    def poll(self, timeout_s):
+        """Wait up to timeout_s for input, accepting and processing it.
+
+        Args:
+          timeout_s: maximum time to wait (seconds).
+        """
+        readable, _, _ = select.select([self._listener] +
+                                       self._connections.keys(), [], [],
+                                       timeout_s)
+        for sock in readable:
+            if sock is self._listener:
+                self._accept()
+            else:
+                self._receive(sock)
+
+    def flush(self):
+        """Write all series updated since the last flush."""
+        if not self._dirty:
+            return
+        logging.info('Writing %d relayed time series', len(self._dirty))
+        dirty = list(self._dirty)
+        self._dirty = set()
+        for start in range(0, len(dirty), self._max_batch):
+            batch = dirty[start:start + self._max_batch]
+            try:
+                self._client.write_time_series([
+                    self._client.time_series(
+                        series.metric,
+                        series.resource,
+                        series.value,
+                        start_time=(self._start_time
+                                    if series.cumulative else None))
+                    for series in batch
+                ])
+            except Exception as err:  # pylint: disable=broad-except
+                logging.error('Failed to write relayed time series; will '
+                              'retry on the next flush: %s', err)
+                self._dirty.update(dirty[start:])
+                return
+
+    def serve_forever(self):
+        """Receive and periodically flush relayed points in perpetuity."""
+        while True:
+            self.poll(max(0, self._next_flush_time - time.time()))
+            if time.time() >= self._next_flush_time:
+                self.flush()
+                self._next_flush_time += self._flush_period_s
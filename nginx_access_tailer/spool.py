@@ -0,0 +1,283 @@
+"""Durable on-disk spool for points that could not be exported."""
+
+import calendar
+import collections
+import logging
+import os
+import struct
+import zlib
+from datetime import datetime
+
+SpooledPoint = collections.namedtuple(
+    'SpooledPoint', ['metric_type', 'labels', 'value', 'start_time',
+                     'end_time'])
+
+# Record: <payload length: uint32> <crc32 of payload: uint32> <payload>
+_RECORD_HEADER = struct.Struct('!II')
+# Payload: <end time: float64> <start time: float64, NaN if a gauge>
+#   <value kind: 'q' or 'd'> <value> <metric type> <label count: uint8>
+#   <label name> <label value> ...
+# with each string as <length: uint16> <utf-8 bytes>.
+_POINT_HEADER = struct.Struct('!ddc')
+_STRING_LENGTH = struct.Struct('!H')
+
+_SEGMENT_SUFFIX = '.spool'
+_HEAD_FILE = 'head'
+
+
+def _to_timestamp(dt):
+    """Returns the POSIX timestamp of a naive UTC datetime (or None)."""
+    if dt is None:
+        return float('nan')
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def _from_timestamp(timestamp):
+    """Returns the naive UTC datetime of a POSIX timestamp (or None)."""
+    if timestamp != timestamp:  # NaN
+        return None
+    return datetime.utcfromtimestamp(timestamp)
+
+
+def _pack_string(value):
+    """Returns a length-prefixed utf-8 encoding of value."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return _STRING_LENGTH.pack(len(value)) + value
+
+
+def _unpack_string(data, offset):
+    """Returns (string, next offset) for a length-prefixed string."""
+    (length,) = _STRING_LENGTH.unpack_from(data, offset)
+    start = offset + _STRING_LENGTH.size
+    return data[start:start + length].decode('utf-8'), start + length
+
+
+def encode_point(point):
+    """Returns the spool record payload for a SpooledPoint."""
+    kind = 'd' if isinstance(point.value, float) else 'q'
+    parts = [
+        _POINT_HEADER.pack(
+            _to_timestamp(point.end_time), _to_timestamp(point.start_time),
+            kind),
+        struct.pack('!' + kind, point.value),
+        _pack_string(point.metric_type),
+        struct.pack('!B', len(point.labels)),
+    ]
+    for name, value in sorted(point.labels.items()):
+        parts.append(_pack_string(name))
+        parts.append(_pack_string(value))
+    return ''.join(parts)
+
+
+def decode_point(data):
+    """Returns the SpooledPoint for a spool record payload."""
+    end_time, start_time, kind = _POINT_HEADER.unpack_from(data, 0)
+    offset = _POINT_HEADER.size
+    (value,) = struct.unpack_from('!' + kind, data, offset)
+    offset += struct.calcsize('!' + kind)
+    metric_type, offset = _unpack_string(data, offset)
+    (num_labels,) = struct.unpack_from('!B', data, offset)
+    offset += 1
+    labels = {}
+    for _ in range(num_labels):
+        name, offset = _unpack_string(data, offset)
+        labels[name], offset = _unpack_string(data, offset)
+    return SpooledPoint(metric_type, labels, value,
+                        _from_timestamp(start_time), _from_timestamp(end_time))
+
+
+class Spool(object):
+    """A size-capped, append-only queue of points, stored on disk.
+
+    Points are stored as CRC-checked binary records in a directory of segment
+    files, appended in batches with a single fsync per batch. They are read
+    back in order with peek / advance, with the read position persisted by
+    sync_head. When the total size exceeds max_bytes, the oldest segments
+    are evicted, unread or not.
+    """
+
+    def __init__(self, directory, max_bytes=64 << 20, segment_bytes=4 << 20):
+        """Open (or create) the spool.
+
+        Args:
+          directory: directory in which to store the spool.
+          max_bytes: maximum total size of the spool (default: 64MB).
+          segment_bytes: target size of each segment file (default: 4MB, or
+            a quarter of max_bytes if smaller).
+        """
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._segment_bytes = min(segment_bytes, max(1, max_bytes // 4))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._segments = sorted(
+            int(name[:-len(_SEGMENT_SUFFIX)])
+            for name in os.listdir(directory)
+            if name.endswith(_SEGMENT_SUFFIX))
+        self._sizes = {}
+        for segment in self._segments:
+            self._sizes[segment] = os.path.getsize(self._path(segment))
+        if self._segments:
+            self._truncate_invalid_tail(self._segments[-1])
+        self._head = self._load_head()
+        self._reader = None
+        self._peeked = None
+
+    def _path(self, segment):
+        """Returns the path of a segment file."""
+        return os.path.join(self._directory,
+                            '%012d%s' % (segment, _SEGMENT_SUFFIX))
+
+    def _read_record(self, fseg):
+        """Returns the next valid record payload from fseg, or None."""
+        header = fseg.read(_RECORD_HEADER.size)
+        if len(header) < _RECORD_HEADER.size:
+            return None
+        length, crc = _RECORD_HEADER.unpack(header)
+        payload = fseg.read(length)
+        if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+            return None
+        return payload
+
+    def _truncate_invalid_tail(self, segment):
+        """Truncate a segment after its last valid record (e.g. on crash)."""
+        with open(self._path(segment), 'r+b') as fseg:
+            valid = 0
+            while self._read_record(fseg) is not None:
+                valid = fseg.tell()
+            if valid < self._sizes[segment]:
+                logging.warning('Truncating invalid spool data in %s',
+                                self._path(segment))
+                fseg.truncate(valid)
+                self._sizes[segment] = valid
+
+    def _load_head(self):
+        """Returns the persisted (segment, offset) read position."""
+        head = None
+        try:
+            with open(os.path.join(self._directory, _HEAD_FILE)) as fhead:
+                segment, offset = [int(x) for x in fhead.read().split()]
+            if segment in self._sizes:
+                head = (segment, min(offset, self._sizes[segment]))
+        except (IOError, ValueError):
+            pass
+        if head is None:
+            head = (self._segments[0], 0) if self._segments else (0, 0)
+        return head
+
+    def sync_head(self):
+        """Persist the read position."""
+        path = os.path.join(self._directory, _HEAD_FILE)
+        with open(path + '.tmp', 'w') as fhead:
+            fhead.write('%d %d' % self._head)
+            fhead.flush()
+            os.fsync(fhead.fileno())
+        os.rename(path + '.tmp', path)
+
+    def size_bytes(self):
+        """Returns the total size of all segments."""
+        return sum(self._sizes.values())
+
+    def empty(self):
+        """Returns True if there are no unread points."""
+        if self._peeked is not None:
+            return False
+        segment, offset = self._head
+        return not self._segments or (segment == self._segments[-1] and
+                                      offset >= self._sizes[segment])
+
+    def append(self, points):
+        """Append a batch of SpooledPoints, syncing them to disk.
+
+        Args:
+          points: list of SpooledPoint.
+        """
+        if not points:
+            return
+        data = []
+        for point in points:
+            payload = encode_point(point)
+            data.append(
+                _RECORD_HEADER.pack(
+                    len(payload),
+                    zlib.crc32(payload) & 0xffffffff) + payload)
+        data = ''.join(data)
+        if (not self._segments or
+                self._sizes[self._segments[-1]] >= self._segment_bytes):
+            segment = self._segments[-1] + 1 if self._segments else 0
+            self._segments.append(segment)
+            self._sizes[segment] = 0
+        segment = self._segments[-1]
+        with open(self._path(segment), 'ab') as fseg:
+            try:
+                fseg.write(data)
+                fseg.flush()
+                os.fsync(fseg.fileno())
+            except (IOError, OSError) as err:
+                # Discard any partial batch, so later appends stay readable.
+                try:
+                    os.ftruncate(fseg.fileno(), self._sizes[segment])
+                except OSError:
+                    pass
+                raise err
+        self._sizes[segment] += len(data)
+        self._evict()
+
+    def _remove_segment(self, segment):
+        """Forget a segment and delete its file."""
+        self._segments.remove(segment)
+        del self._sizes[segment]
+        try:
+            os.unlink(self._path(segment))
+        except OSError as err:
+            logging.error('Failed to remove spool segment: %s', err)
+
+    def _evict(self):
+        """Remove the oldest segments while over the size limit."""
+        while len(self._segments) > 1 and self.size_bytes() > self._max_bytes:
+            segment = self._segments[0]
+            logging.warning('Spool full: evicting %d bytes of oldest points',
+                            self._sizes[segment])
+            self._remove_segment(segment)
+            if self._head[0] <= segment:
+                self._head = (self._segments[0], 0)
+                self._close_reader()
+
+    def _close_reader(self):
+        """Close the current segment reader, discarding any peeked point."""
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        self._peeked = None
+
+    def peek(self):
+        """Returns the oldest unread SpooledPoint, or None if empty."""
+        while self._peeked is None:
+            if self.empty():
+                return None
+            segment, offset = self._head
+            if offset >= self._sizes[segment]:
+                # Finished with a segment (which is not the newest).
+                self._close_reader()
+                self._remove_segment(segment)
+                self._head = (self._segments[0], 0)
+                continue
+            if self._reader is None:
+                self._reader = open(self._path(segment), 'rb')
+            self._reader.seek(offset)
+            payload = self._read_record(self._reader)
+            if payload is None:
+                logging.warning('Skipping invalid spool data in %s',
+                                self._path(segment))
+                self._head = (segment, self._sizes[segment])
+                continue
+            self._peeked = (decode_point(payload), self._reader.tell())
+        return self._peeked[0]
+
+    def advance(self):
+        """Consume the point last returned by peek."""
+        if self._peeked is None:
+            return
+        self._head = (self._head[0], self._peeked[1])
+        self._peeked = None
@@ -0,0 +1,215 @@
+"""Receiver for nginx access logs sent over syslog."""
+
+import errno
+import logging
+import os
+import select
+import socket
+import stat
+
+
+class SyslogReceiver(object):
+    """Receives nginx access log lines sent as syslog datagrams.
+
+    nginx can log directly to syslog, e.g.
+
+      access_log syslog:server=127.0.0.1:5140 combined;
+      access_log syslog:server=unix:/var/run/nginx-access.sock combined;
+
+    which avoids the disk write and rotation handling of tailing a file. The
+    receiver binds the corresponding local UDP or unix datagram socket, and
+    exposes the same get_lines / backlog_bytes interface as SimpleTailer, so
+    it can stand in as the source of NginxAccessLogTailer. Its wait method
+    lets the watch loop block until datagrams arrive, rather than polling.
+
+    Datagrams are received into a single preallocated buffer, with only the
+    payload (following the syslog header) copied out. Datagrams larger than
+    max_datagram_bytes are counted as oversized and discarded, as are those
+    without a recognizable syslog header (malformed). Where available (UDP on
+    Linux), datagrams dropped by the kernel due to a full receive buffer are
+    also counted. Any increase in these counts is logged.
+
+    If get_lines stops at max_batch datagrams, backlog_bytes reports the
+    bytes still queued on the socket (or 1, if unknown), so that the watch
+    loop reads again without waiting.
+    """
+
+    def __init__(self,
+                 address,
+                 max_datagram_bytes=8192,
+                 max_batch=10000,
+                 rcvbuf_bytes=4 << 20):
+        """Create the receiver, binding its socket.
+
+        Args:
+          address: address to listen on, either 'unix:<path>' for a unix
+            datagram socket or '<host>:<port>' for UDP.
+          max_datagram_bytes: maximum accepted datagram size (default: 8192).
+          max_batch: maximum number of datagrams returned by a single call to
+            get_lines (default: 10000).
+          rcvbuf_bytes: requested socket receive buffer size, which must hold
+            all datagrams arriving between calls to get_lines (default: 4MB).
+        """
+        self._unix_path = None
+        if address.startswith('unix:'):
+            self._unix_path = address[len('unix:'):]
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._remove_socket_file()
+            bind_address = self._unix_path
+        else:
+            host, port = address.rsplit(':', 1)
+            family = socket.AF_INET6 if ':' in host else socket.AF_INET
+            self._sock = socket.socket(family, socket.SOCK_DGRAM)
+            bind_address = (host.strip('[]'), int(port))
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                              rcvbuf_bytes)
+        # Linux doubles the requested size (for bookkeeping overhead), capped
+        # at twice net.core.rmem_max.
+        actual_rcvbuf_bytes = self._sock.getsockopt(socket.SOL_SOCKET,
+                                                    socket.SO_RCVBUF)
+        if actual_rcvbuf_bytes < rcvbuf_bytes:
+            logging.warning(
+                'Syslog socket receive buffer is %d bytes, less than the '
+                'requested %d (see net.core.rmem_max)', actual_rcvbuf_bytes,
+                rcvbuf_bytes)
+        self._sock.bind(bind_address)
+        self._sock.setblocking(False)
+        self._max_datagram_bytes = max_datagram_bytes
+        self._max_batch = max_batch
+        # One extra byte, so that oversized datagrams can be detected.
+        self._buffer = bytearray(max_datagram_bytes + 1)
+        self._view = memoryview(self._buffer)
+        self._received = 0
+        self._oversized = 0
+        self._malformed = 0
+        self._batch_full = False
+        self._rx_queue_bytes = None
+        self._kernel_drops_base = self._socket_queue()[1]
+        self._dropped = 0
+        logging.info('Listening for syslog datagrams on %s', address)
+
+    def address(self):
+        """Returns the bound socket address."""
+        return self._sock.getsockname()
+
+    def close(self):
+        """Close the socket (removing it, if a unix socket)."""
+        self._sock.close()
+        if self._unix_path is not None:
+            self._remove_socket_file()
+
+    def _remove_socket_file(self):
+        """Remove a (stale) unix socket at our path, but not other files."""
+        try:
+            mode = os.lstat(self._unix_path).st_mode
+        except OSError:
+            return
+        if stat.S_ISSOCK(mode):
+            os.unlink(self._unix_path)
+
+    def _socket_queue(self):
+        """Returns (queued bytes, kernel drops) for our socket.
+
+        Only supported for UDP sockets on Linux, by way of /proc/net/udp{,6};
+        (None, None) otherwise.
+        """
+        if self._unix_path is not None:
+            return None, None
+        inode = str(os.fstat(self._sock.fileno()).st_ino)
+        for table in ('/proc/net/udp', '/proc/net/udp6'):
+            try:
+                with open(table) as fproc:
+                    next(fproc)
+                    for entry in fproc:
+                        fields = entry.split()
+                        if fields[9] == inode:
+                            return (int(fields[4].split(':')[1], 16),
+                                    int(fields[-1]))
+            except (IOError, IndexError, StopIteration, ValueError):
+                continue
+        return None, None
+
+    def stats(self):
+        """Returns a dict of datagram counters since the receiver was created.
+
+        Keys are received, oversized, malformed and dropped (kernel drops; None
+        if unknown).
+        """
+        dropped = self._socket_queue()[1]
+        if dropped is not None and self._kernel_drops_base is not None:
+            dropped -= self._kernel_drops_base
+        return {
+            'received': self._received,
+            'oversized': self._oversized,
+            'malformed': self._malformed,
+            'dropped': dropped,
+        }
+
+    def _payload(self, size):
+        """Returns the payload of the datagram in the buffer, or None.
+
+        RFC 3164 style headers, as sent by nginx, are of the form
+        '<PRI>TIMESTAMP HOSTNAME TAG: ', with the hostname optional; the
+        payload follows the first ': '.
+        """
+        if size == 0 or self._buffer[0] != ord('<'):
+            return None
+        start = self._buffer.find(': ', 0, size)
+        if start < 0:
+            return None
+        return self._view[start + 2:size].tobytes()
+
+    def get_lines(self):
+        """Returns the access log lines received since the last call.
+
+        Returns:
+          List of access log lines (possibly empty).
+        """
+        lines = []
+        discarded = (self._oversized, self._malformed, self._dropped)
+        while len(lines) < self._max_batch:
+            try:
+                size = self._sock.recv_into(self._buffer)
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            self._received += 1
+            if size > self._max_datagram_bytes:
+                self._oversized += 1
+                continue
+            payload = self._payload(size)
+            if payload is None:
+                self._malformed += 1
+                continue
+            lines.append(payload)
+        self._batch_full = len(lines) >= self._max_batch
+        self._rx_queue_bytes, dropped = self._socket_queue()
+        if dropped is not None and self._kernel_drops_base is not None:
+            self._dropped = dropped - self._kernel_drops_base
+        if (self._oversized, self._malformed, self._dropped) != discarded:
+            logging.warning('Discarded syslog datagrams: %s', str(self.stats()))
+        return lines
+
+    def wait(self, timeout_s):
+        """Wait up to timeout_s for a datagram to arrive.
+
+        Args:
+          timeout_s: maximum time to wait (seconds).
+        """
+        try:
+            select.select([self._sock], [], [], timeout_s)
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                raise
+
+    def backlog_bytes(self):
+        """Returns the bytes queued on the socket if the last batch was full.
+
+        Returns 0 if get_lines last returned fewer than max_batch lines, as
+        the socket was then drained (datagrams arriving since are not counted
+        as backlog).
+        """
+        if not self._batch_full:
+            return 0
+        return self._rx_queue_bytes or 1
@@ -1,5 +1,10 @@
 """Tests for InstanceMetadata."""
 
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
 import urllib2
 
@@ -23,9 +28,9 @@ class TestInstanceMetadata(unittest.TestCase):
         mock_request.return_value = mock_req
         mock_urlopen.return_value = mock_readable
 
-        metadata = InstanceMetadata()
+        metadata = InstanceMetadata(timeout_s=5)
         self.assertEqual(metadata.fetch('blah'), 'foo')
-        mock_urlopen.assert_called_once_with(mock_req)
+        mock_urlopen.assert_called_once_with(mock_req, timeout=5)
         mock_request.assert_called_once()
         mock_readable.read.assert_called_once()
 
@@ -38,9 +43,28 @@ class TestInstanceMetadata(unittest.TestCase):
         mock_request.return_value = mock_req
         mock_urlopen.side_effect = urllib2.URLError('Oops')
 
-        metadata = InstanceMetadata()
+        metadata = InstanceMetadata(timeout_s=5, retries=0)
         self.assertEqual(metadata.fetch('blah'), None)
-        mock_urlopen.assert_called_once_with(mock_req)
+        mock_urlopen.assert_called_once_with(mock_req, timeout=5)
+        mock_request.assert_called_once()
+
+    @mock.patch('time.sleep')
+    @mock.patch('urllib2.Request')
+    @mock.patch('urllib2.urlopen')
+    def test_fetch_retries(self, mock_urlopen, mock_request, mock_sleep):
+        """fetch retries failed requests, with exponential backoff."""
+        mock_readable = mock.MagicMock(name='Readable')
+        mock_readable.read.return_value = 'foo'
+
+        mock_urlopen.side_effect = [
+            urllib2.URLError('Oops'),
+            urllib2.URLError('Oops'), mock_readable
+        ]
+
+        metadata = InstanceMetadata(retries=2, retry_delay_s=1)
+        self.assertEqual(metadata.fetch('blah'), 'foo')
+        self.assertEqual(mock_urlopen.call_count, 3)
+        mock_sleep.assert_has_calls([mock.call(1), mock.call(2)])
         mock_request.assert_called_once()
 
     @mock.patch.object(InstanceMetadata, 'fetch')
@@ -60,3 +84,86 @@ class TestInstanceMetadata(unittest.TestCase):
         metadata = InstanceMetadata()
         self.assertEqual(metadata.instance_zone(), 'baz')
         mock_fetch.assert_called_once_with('zone')
+
+
+class TestInstanceMetadataCache(unittest.TestCase):
+    """Test caching and concurrent fetches in InstanceMetadata."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmpdir, 'metadata.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('urllib2.urlopen')
+    def test_fetch_all(self, mock_urlopen):
+        """fetch_all fetches each entry, and memoizes the results."""
+
+        def urlopen(request, timeout):
+            """Return the requested entry name."""
+            _ = timeout
+            mock_readable = mock.MagicMock(name='Readable')
+            mock_readable.read.return_value = request.get_full_url().split(
+                '/')[-1]
+            return mock_readable
+
+        mock_urlopen.side_effect = urlopen
+
+        metadata = InstanceMetadata()
+        self.assertEqual(
+            metadata.fetch_all(['id', 'zone']), {
+                'id': 'id',
+                'zone': 'zone'
+            })
+        self.assertEqual(metadata.instance_id(), 'id')
+        self.assertEqual(mock_urlopen.call_count, 2)
+
+    @mock.patch('urllib2.urlopen')
+    def test_cache_file(self, mock_urlopen):
+        """Fetched entries are read back from the cache file."""
+        mock_readable = mock.MagicMock(name='Readable')
+        mock_readable.read.return_value = 'foo'
+        mock_urlopen.return_value = mock_readable
+
+        metadata = InstanceMetadata(cache_file=self.cache_file)
+        self.assertEqual(metadata.fetch_all(['id']), {'id': 'foo'})
+        mock_urlopen.assert_called_once()
+
+        mock_urlopen.reset_mock()
+        metadata = InstanceMetadata(cache_file=self.cache_file)
+        self.assertEqual(metadata.instance_id(), 'foo')
+        mock_urlopen.assert_not_called()
+
+    @mock.patch('urllib2.urlopen')
+    def test_cache_file_expiry(self, mock_urlopen):
+        """Expired or unreadable cache file entries are re-fetched."""
+        with open(self.cache_file, 'w') as fcache:
+            json.dump({'id': ['old', time.time() - 100]}, fcache)
+
+        mock_readable = mock.MagicMock(name='Readable')
+        mock_readable.read.return_value = 'new'
+        mock_urlopen.return_value = mock_readable
+
+        metadata = InstanceMetadata(cache_file=self.cache_file, cache_ttl_s=10)
+        self.assertEqual(metadata.instance_id(), 'new')
+        mock_urlopen.assert_called_once()
+        with open(self.cache_file) as fcache:
+            self.assertEqual(json.load(fcache)['id'][0], 'new')
+
+        with open(self.cache_file, 'w') as fcache:
+            fcache.write('garbage')
+        metadata = InstanceMetadata(cache_file=self.cache_file)
+        self.assertEqual(metadata.instance_id(), 'new')
+        self.assertEqual(mock_urlopen.call_count, 2)
+
+        # Valid JSON of the wrong shape is also ignored.
+        for contents in ('[]', '{"id": "abc"}', '{"id": ["a"]}',
+                         '{"id": [1, "x"]}', '{"id": ["a", true]}'):
+            with open(self.cache_file, 'w') as fcache:
+                fcache.write(contents)
+            mock_urlopen.reset_mock()
+            metadata = InstanceMetadata(cache_file=self.cache_file)
+            self.assertEqual(metadata.fetch_all(['id', 'zone']),
+                             {'id': 'new', 'zone': mock.ANY})
+            self.assertEqual(mock_urlopen.call_count, 2)
@@ -1,11 +1,14 @@
 """Tests for NginxAccessLogConsumer."""
 
 import datetime
+import shutil
+import tempfile
 import unittest
 
 import mock
 
 from nginx_access_tailer import NginxAccessLogConsumer
+from nginx_access_tailer.spool import Spool
 
 
 class TestNginxAccessLogConsumer(unittest.TestCase):
@@ -201,3 +204,433 @@ class TestNginxAccessLogConsumer(unittest.TestCase):
                     start_time=mock.ANY),
             ],
             any_order=True)
+
+    def test_weighted_recording(self):
+        """Record weights are added to the counts."""
+        mock_monitoring_client = mock.MagicMock(name='Client')
+        mock_monitoring_resource = mock.MagicMock(name='Resource')
+
+        consumer = NginxAccessLogConsumer(mock_monitoring_client,
+                                          mock_monitoring_resource,
+                                          'custom.googleapis.com/foo')
+
+        timestamp = self.timestamp_at_delta(consumer, seconds=10)
+
+        mock_monitoring_client.metric.side_effect = ['200_metric']
+
+        consumer.record({'datetime': timestamp, 'statuscode': '200'})
+        consumer.record(
+            {
+                'datetime': timestamp,
+                'statuscode': '200'
+            }, weight=10)
+        consumer.commit()
+
+        mock_monitoring_client.write_point.assert_called_once_with(
+            '200_metric', mock_monitoring_resource, 11, start_time=mock.ANY)
+
+    def test_sampling_rate(self):
+        """The sampling rate is written when changed or counts are updated."""
+        mock_monitoring_client = mock.MagicMock(name='Client')
+        mock_monitoring_resource = mock.MagicMock(name='Resource')
+
+        consumer = NginxAccessLogConsumer(
+            mock_monitoring_client,
+            mock_monitoring_resource,
+            'custom.googleapis.com/foo',
+            sampling_rate_metric_name='custom.googleapis.com/rate')
+
+        timestamp = self.timestamp_at_delta(consumer, seconds=10)
+
+        mock_monitoring_client.metric.side_effect = [
+            'rate_metric', '200_metric'
+        ]
+
+        # Initial rate is written, even with no counts.
+        consumer.commit()
+        mock_monitoring_client.write_point.assert_called_once_with(
+            'rate_metric', mock_monitoring_resource, 1.0)
+
+        # Unchanged: nothing written.
+        mock_monitoring_client.write_point.reset_mock()
+        consumer.commit()
+        mock_monitoring_client.write_point.assert_not_called()
+
+        # Changed, alongside counts.
+        consumer.set_sampling_rate(0.1)
+        consumer.record(
+            {
+                'datetime': timestamp,
+                'statuscode': '200'
+            }, weight=10)
+        consumer.commit()
+        mock_monitoring_client.metric.assert_has_calls([
+            mock.call(type_='custom.googleapis.com/rate', labels={}),
+            mock.call(
+                type_='custom.googleapis.com/foo',
+                labels={'response_code': '200'}),
+        ])
+        mock_monitoring_client.write_point.assert_has_calls([
+            mock.call('rate_metric', mock_monitoring_resource, 0.1),
+            mock.call(
+                '200_metric',
+                mock_monitoring_resource,
+                10,
+                start_time=mock.ANY),
+        ])
+
+    def test_dimensions(self):
+        """Counts are broken down by the configured dimensions."""
+        mock_monitoring_client = mock.MagicMock(name='Client')
+        mock_monitoring_resource = mock.MagicMock(name='Resource')
+
+        consumer = NginxAccessLogConsumer(
+            mock_monitoring_client,
+            mock_monitoring_resource,
+            'custom.googleapis.com/foo',
+            dimensions=('method', 'status_class', 'http_version', 'upstream'))
+
+        timestamp = self.timestamp_at_delta(consumer, seconds=10)
+
+        records = [
+            {
+                'datetime': timestamp,
+                'statuscode': '200',
+                'method': 'GET',
+                'httpversion': 'HTTP/1.1'
+            },
+            {
+                'datetime': timestamp,
+                'statuscode': '204',
+                'method': 'GET',
+                'httpversion': 'HTTP/1.1'
+            },
+            {
+                'datetime': timestamp,
+                'statuscode': '503',
+                'method': 'POST',
+                'httpversion': 'HTTP/2.0',
+                # Retried: the last upstream produced the response.
+                'upstream': '10.0.0.2:8080, 10.0.0.1:8080'
+            },
+        ]
+
+        mock_monitoring_client.metric.side_effect = [
+            'get_metric', 'post_metric'
+        ]
+
+        for record in records:
+            consumer.record(record)
+        consumer.commit()
+
+        mock_monitoring_client.metric.assert_has_calls([
+            mock.call(
+                type_='custom.googleapis.com/foo',
+                labels={
+                    'method': 'GET',
+                    'status_class': '2xx',
+                    'http_version': 'HTTP/1.1',
+                    'upstream': '-'
+                }),
+            mock.call(
+                type_='custom.googleapis.com/foo',
+                labels={
+                    'method': 'POST',
+                    'status_class': '5xx',
+                    'http_version': 'HTTP/2.0',
+                    'upstream': '10.0.0.1:8080'
+                }),
+        ])
+        mock_monitoring_client.write_point.assert_has_calls([
+            mock.call(
+                'get_metric', mock_monitoring_resource, 2,
+                start_time=mock.ANY),
+            mock.call(
+                'post_metric', mock_monitoring_resource, 1,
+                start_time=mock.ANY),
+        ])
+
+    def test_label_set_overflow(self):
+        """Label sets beyond the limit are counted in an overflow series."""
+        mock_monitoring_client = mock.MagicMock(name='Client')
+        mock_monitoring_resource = mock.MagicMock(name='Resource')
+
+        consumer = NginxAccessLogConsumer(
+            mock_monitoring_client,
+            mock_monitoring_resource,
+            'custom.googleapis.com/foo',
+            dimensions=('response_code', 'method'),
+            max_label_sets=2)
+
+        timestamp = self.timestamp_at_delta(consumer, seconds=10)
+
+        for code, method in [('200', 'GET'), ('200', 'POST'), ('404', 'GET'),
+                             ('500', 'PUT'), ('200', 'GET')]:
+            consumer.record({
+                'datetime': timestamp,
+                'statuscode': code,
+                'method': method
+            })
+
+        mock_monitoring_client.metric.side_effect = [
+            'get_metric', 'post_metric', 'overflow_metric'
+        ]
+        consumer.commit()
+
+        self.assertEqual(mock_monitoring_client.metric.call_count, 3)
+        mock_monitoring_client.metric.assert_called_with(
+            type_='custom.googleapis.com/foo',
+            labels={
+                'response_code': '0',
+                'method': 'other'
+            })
+        mock_monitoring_client.write_point.assert_has_calls([
+            mock.call(
+                'get_metric', mock_monitoring_resource, 2,
+                start_time=mock.ANY),
+            mock.call(
+                'post_metric', mock_monitoring_resource, 1,
+                start_time=mock.ANY),
+            mock.call(
+                'overflow_metric',
+                mock_monitoring_resource,
+                2,
+                start_time=mock.ANY),
+        ])
+
+    def test_bytes_sent(self):
+        """Bytes sent are accumulated by status class, scaled by weight."""
+        mock_monitoring_client = mock.MagicMock(name='Client')
+        mock_monitoring_resource = mock.MagicMock(name='Resource')
+
+        consumer = NginxAccessLogConsumer(
+            mock_monitoring_client,
+            mock_monitoring_resource,
+            'custom.googleapis.com/foo',
+            http_response_bytes_metric_name='custom.googleapis.com/bytes')
+
+        timestamp = self.timestamp_at_delta(consumer, seconds=10)
+
+        records = [
+            {
+                'datetime': timestamp,
+                'statuscode': '200',
+                'bytessent': '1000'
+            },
+            {
+                'datetime': timestamp,
+                'statuscode': '204',
+                'bytessent': '0'
+            },
+            {
+                'datetime': timestamp,
+                'statuscode': '404',
+                'bytessent': '150'
+            },
+        ]
+
+        mock_monitoring_client.metric.side_effect = [
+            '200_metric', '204_metric', '404_metric', '2xx_bytes_metric',
+            '4xx_bytes_metric'
+        ]
+
+        for record in records:
+            consumer.record(record)
+        # 64-bit totals, beyond the range of 32-bit integers.
+        consumer.record(
+            {
+                'datetime': timestamp,
+                'statuscode': '200',
+                'bytessent': str(1 << 32)
+            },
+            weight=2)
+        consumer.commit()
+
+        mock_monitoring_client.metric.assert_has_calls([
+            mock.call(
+                type_='custom.googleapis.com/bytes',
+                labels={'status_class': '2xx'}),
+            mock.call(
+                type_='custom.googleapis.com/bytes',
+                labels={'status_class': '4xx'}),
+        ])
+        mock_monitoring_client.write_point.assert_has_calls([
+            mock.call(
+                '2xx_bytes_metric',
+                mock_monitoring_resource,
+                1000 + (2 << 32),
+                start_time=mock.ANY),
+            mock.call(
+                '4xx_bytes_metric',
+                mock_monitoring_resource,
+                150,
+                start_time=mock.ANY),
+        ])
+
+    def test_write_failure_without_spool(self):
+        """Failed writes do not raise, and are retried on the next commit."""
+        mock_monitoring_client = mock.MagicMock(name='Client')
+        mock_monitoring_resource = mock.MagicMock(name='Resource')
+
+        consumer = NginxAccessLogConsumer(mock_monitoring_client,
+                                          mock_monitoring_resource,
+                                          'custom.googleapis.com/foo')
+        timestamp = self.timestamp_at_delta(consumer, seconds=10)
+        mock_monitoring_client.metric.return_value = '200_metric'
+        mock_monitoring_client.write_point.side_effect = IOError('down')
+
+        consumer.record({'datetime': timestamp, 'statuscode': '200'})
+        consumer.commit()
+
+        mock_monitoring_client.write_point.reset_mock()
+        mock_monitoring_client.write_point.side_effect = None
+        consumer.commit()
+        mock_monitoring_client.write_point.assert_called_once_with(
+            '200_metric', mock_monitoring_resource, 1, start_time=mock.ANY)
+
+    def test_write_failure_spooled(self):
+        """Failed writes are spooled, then replayed in order."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        mock_monitoring_client = mock.MagicMock(name='Client')
+        mock_monitoring_resource = mock.MagicMock(name='Resource')
+        mock_monitoring_client.metric.side_effect = (
+            lambda type_, labels: (type_, labels['response_code']))
+
+        consumer = NginxAccessLogConsumer(
+            mock_monitoring_client,
+            mock_monitoring_resource,
+            'custom.googleapis.com/foo',
+            spool=Spool(tmpdir),
+            spool_replay_max_points=2)
+        timestamp = self.timestamp_at_delta(consumer, seconds=10)
+
+        # The first point is written; the rest are spooled.
+        mock_monitoring_client.write_point.side_effect = [
+            None, IOError('down')
+        ]
+        for code in ('200', '404', '500'):
+            consumer.record({'datetime': timestamp, 'statuscode': code})
+        consumer.commit()
+        self.assertEqual(mock_monitoring_client.write_point.call_count, 2)
+
+        # While the spool is not empty, new points are held back, with
+        # replay failing on a server error.
+        error = IOError('unavailable')
+        error.code = 503
+        mock_monitoring_client.write_point.reset_mock()
+        mock_monitoring_client.write_point.side_effect = error
+        consumer.record({'datetime': timestamp, 'statuscode': '200'})
+        consumer.commit()
+        self.assertEqual(mock_monitoring_client.write_point.call_count, 1)
+
+        # Recovered: the spooled points are replayed in order, then the
+        # latest point of each series is written.
+        metric = lambda code: ('custom.googleapis.com/foo', code)
+        mock_monitoring_client.write_point.reset_mock()
+        mock_monitoring_client.write_point.side_effect = None
+        consumer.commit()
+        mock_monitoring_client.write_point.assert_has_calls([
+            mock.call(metric(code), mock_monitoring_resource, 1,
+                      end_time=mock.ANY, start_time=consumer.reset_time_utc())
+            for code in ('404', '500')
+        ] + [
+            mock.call(metric(code), mock_monitoring_resource, count,
+                      start_time=consumer.reset_time_utc())
+            for code, count in (('200', 2), ('404', 1), ('500', 1))
+        ])
+        self.assertEqual(mock_monitoring_client.write_point.call_count, 5)
+
+        # Spool drained: points are written directly again.
+        mock_monitoring_client.write_point.reset_mock()
+        consumer.record({'datetime': timestamp, 'statuscode': '404'})
+        consumer.commit()
+        mock_monitoring_client.write_point.assert_any_call(
+            metric('404'), mock_monitoring_resource, 2,
+            start_time=consumer.reset_time_utc())
+
+    def test_spool_drains_under_load(self):
+        """The spool drains with more series than are replayed per commit."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        mock_monitoring_client = mock.MagicMock(name='Client')
+        mock_monitoring_resource = mock.MagicMock(name='Resource')
+        spool = Spool(tmpdir)
+
+        consumer = NginxAccessLogConsumer(
+            mock_monitoring_client,
+            mock_monitoring_resource,
+            'custom.googleapis.com/foo',
+            spool=spool,
+            spool_replay_max_points=2)
+        timestamp = self.timestamp_at_delta(consumer, seconds=10)
+        codes = ('200', '301', '404', '500')
+        for code in codes:
+            consumer.record({'datetime': timestamp, 'statuscode': code})
+        mock_monitoring_client.write_point.side_effect = IOError('down')
+        consumer.commit()
+        self.assertFalse(spool.empty())
+
+        mock_monitoring_client.write_point.side_effect = None
+        for _ in range(2):
+            for code in codes:
+                consumer.record({'datetime': timestamp, 'statuscode': code})
+            consumer.commit()
+        self.assertTrue(spool.empty())
+
+    def test_replay_failure_keeps_head(self):
+        """The spool read position is only saved when replay progresses."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        mock_monitoring_client = mock.MagicMock(name='Client')
+        mock_monitoring_resource = mock.MagicMock(name='Resource')
+        spool = Spool(tmpdir)
+
+        consumer = NginxAccessLogConsumer(
+            mock_monitoring_client,
+            mock_monitoring_resource,
+            'custom.googleapis.com/foo',
+            spool=spool)
+        timestamp = self.timestamp_at_delta(consumer, seconds=10)
+        mock_monitoring_client.write_point.side_effect = IOError('down')
+        consumer.record({'datetime': timestamp, 'statuscode': '200'})
+        consumer.commit()
+
+        with mock.patch.object(spool, 'sync_head') as mock_sync_head:
+            consumer.commit()
+            self.assertFalse(mock_sync_head.called)
+            mock_monitoring_client.write_point.side_effect = None
+            consumer.commit()
+            mock_sync_head.assert_called_once_with()
+
+    def test_spool_failure(self):
+        """If spooling fails, writes are retried on the next commit."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        mock_monitoring_client = mock.MagicMock(name='Client')
+        mock_monitoring_resource = mock.MagicMock(name='Resource')
+        mock_monitoring_client.metric.return_value = '200_metric'
+        spool = Spool(tmpdir)
+
+        consumer = NginxAccessLogConsumer(
+            mock_monitoring_client,
+            mock_monitoring_resource,
+            'custom.googleapis.com/foo',
+            spool=spool)
+        timestamp = self.timestamp_at_delta(consumer, seconds=10)
+        mock_monitoring_client.write_point.side_effect = IOError('down')
+
+        consumer.record({'datetime': timestamp, 'statuscode': '200'})
+        with mock.patch.object(
+                spool, 'append',
+                side_effect=IOError(28, 'No space left on device')):
+            # Does not raise.
+            consumer.commit()
+        self.assertTrue(spool.empty())
+
+        mock_monitoring_client.write_point.reset_mock()
+        mock_monitoring_client.write_point.side_effect = None
+        consumer.record({'datetime': timestamp, 'statuscode': '200'})
+        consumer.commit()
+        mock_monitoring_client.write_point.assert_called_once_with(
+            '200_metric', mock_monitoring_resource, 2, start_time=mock.ANY)
@@ -1,13 +1,15 @@
-"""Tests for NginxAccessLogTailer and supporting bits.
-
-TODO(swfrench): Add test for SimpleTailer.
-"""
+"""Tests for NginxAccessLogTailer and supporting bits."""
 
+import os
+import shutil
+import tempfile
 import unittest
 
 import mock
 
 from nginx_access_tailer import NginxAccessLogTailer
+from nginx_access_tailer.nginx_access_log_tailer import PollingScheduler
+from nginx_access_tailer.nginx_access_log_tailer import SimpleTailer
 
 
 class SleepExit(Exception):
@@ -15,6 +17,186 @@ class SleepExit(Exception):
     pass
 
 
+class TestSimpleTailer(unittest.TestCase):
+    """Tests for SimpleTailer, using a real log file and writer."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'access.log')
+        self.writer = self.open_writer()
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.tmpdir)
+
+    def open_writer(self):
+        """Open the log file for appending, as nginx does."""
+        return open(self.filename, 'a')
+
+    def write(self, data, writer=None):
+        """Write data to the log file and flush it."""
+        writer = writer or self.writer
+        writer.write(data)
+        writer.flush()
+
+    def test_deprecated_arguments(self):
+        """The former rotation check arguments are accepted and ignored."""
+        tailer = SimpleTailer(self.filename, 30, 10)
+        self.write('a\n')
+        self.assertEqual(tailer.get_lines(), ['a\n'])
+        tailer = NginxAccessLogTailer(self.filename, mock.MagicMock(), 120, 60)
+        # pylint: disable=protected-access
+        self.assertEqual(tailer._tailer.get_lines(), ['a\n'])
+
+    def test_missing_file(self):
+        """get_lines returns None if the log file cannot be opened."""
+        tailer = SimpleTailer(os.path.join(self.tmpdir, 'missing.log'))
+        self.assertIsNone(tailer.get_lines())
+
+    def test_appended_lines(self):
+        """Appended lines are returned, with partial lines held back."""
+        tailer = SimpleTailer(self.filename)
+        self.assertEqual(tailer.get_lines(), [])
+        self.write('a\nb\n')
+        self.assertEqual(tailer.get_lines(), ['a\n', 'b\n'])
+        self.write('c\nd')
+        self.assertEqual(tailer.get_lines(), ['c\n'])
+        self.write('e\n')
+        self.assertEqual(tailer.get_lines(), ['de\n'])
+        self.assertEqual(tailer.get_lines(), [])
+
+    def test_rename_rotation(self):
+        """The old file is drained before switching to the new one."""
+        tailer = SimpleTailer(self.filename)
+        self.write('a\nb\n')
+        self.assertEqual(tailer.get_lines(), ['a\n', 'b\n'])
+
+        # Written before rotation, but after our last read.
+        self.write('c\n')
+        os.rename(self.filename, self.filename + '.1')
+        # The writer has not yet reopened its log, and keeps writing to the
+        # rotated file.
+        self.write('d\n')
+        self.assertEqual(tailer.get_lines(), ['c\n', 'd\n'])
+
+        # Finally, the writer reopens its log.
+        self.write('e\n')
+        new_writer = self.open_writer()
+        self.write('f\n', writer=new_writer)
+        self.writer.close()
+        self.writer = new_writer
+        self.assertEqual(tailer.get_lines(), ['e\n', 'f\n'])
+
+        self.write('g\n')
+        self.assertEqual(tailer.get_lines(), ['g\n'])
+
+    def test_max_read_bytes(self):
+        """Reads are bounded, with the remainder reported as backlog."""
+        # Note: Reads may be rounded up to an internal buffer size.
+        self.write('x' * 99 + '\n' * 100000)
+        tailer = SimpleTailer(self.filename, max_read_bytes=100)
+        lines = tailer.get_lines()
+        self.assertTrue(lines)
+        self.assertEqual(lines[0], 'x' * 99 + '\n')
+        self.assertTrue(0 < tailer.backlog_bytes() < 100000)
+        while tailer.backlog_bytes():
+            lines.extend(tailer.get_lines())
+        self.assertEqual(len(lines), 100000)
+
+    def test_rename_rotation_with_backlog(self):
+        """Rotation waits until the old file is read up to its size."""
+        tailer = SimpleTailer(self.filename, max_read_bytes=10)
+        self.assertEqual(tailer.get_lines(), [])
+        self.write('a\n' * 100000)
+        os.rename(self.filename, self.filename + '.1')
+        self.writer.close()
+        self.writer = self.open_writer()
+        self.write('b\n')
+        lines = tailer.get_lines()
+        self.assertEqual(lines, ['a\n'] * len(lines))
+        while len(lines) < 100001:
+            lines.extend(tailer.get_lines())
+        self.assertEqual(lines, ['a\n'] * 100000 + ['b\n'])
+
+    def test_copytruncate_rotation(self):
+        """Reading resumes from the start of the file after truncation."""
+        tailer = SimpleTailer(self.filename)
+        self.write('a\nb\n')
+        self.assertEqual(tailer.get_lines(), ['a\n', 'b\n'])
+
+        shutil.copy(self.filename, self.filename + '.1')
+        with open(self.filename, 'r+') as ftrunc:
+            ftrunc.truncate(0)
+        self.write('c\n')
+        self.assertEqual(tailer.get_lines(), ['c\n'])
+
+        self.write('d\n')
+        self.assertEqual(tailer.get_lines(), ['d\n'])
+
+    def test_copytruncate_refilled_past_offset(self):
+        """Truncation is detected even if refilled past the read offset."""
+        tailer = SimpleTailer(self.filename, max_read_bytes=10)
+        self.assertEqual(tailer.get_lines(), [])
+        self.write('a\n' * 100000)
+        lines = tailer.get_lines()
+        self.assertEqual(lines, ['a\n'] * len(lines))
+        self.assertTrue(tailer.backlog_bytes())
+
+        with open(self.filename, 'r+') as ftrunc:
+            ftrunc.truncate(0)
+        self.write('b\n' * 50000)
+        lines = tailer.get_lines()
+        while tailer.backlog_bytes():
+            lines.extend(tailer.get_lines())
+        self.assertEqual(lines, ['b\n'] * 50000)
+
+
+class TestPollingScheduler(unittest.TestCase):
+    """Tests for PollingScheduler."""
+
+    def test_fixed_period(self):
+        """Equal min and max periods yield a fixed polling period."""
+        scheduler = PollingScheduler(30, 30)
+        self.assertEqual(scheduler.update(0, 0.0), 30)
+        self.assertEqual(scheduler.update(5000, 30.0), 30)
+
+    def test_invalid_bounds(self):
+        """The minimum period may not exceed the maximum."""
+        with self.assertRaises(ValueError):
+            PollingScheduler(10, 1)
+
+    def test_adapts_to_rate(self):
+        """The period tracks target batch size over arrival rate."""
+        scheduler = PollingScheduler(1, 30, target_batch_lines=100,
+                                     smoothing=1.0)
+        self.assertEqual(scheduler.update(0, 0.0), 30)
+        # 50 lines / s => 2 s to accumulate 100 lines.
+        self.assertEqual(scheduler.update(50, 1.0), 2)
+        self.assertEqual(scheduler.rate(), 50)
+        # 1 line / s => clamped to the max.
+        self.assertEqual(scheduler.update(2, 3.0), 30)
+
+    def test_backlog_uses_min_period(self):
+        """A poll returning a full batch or more drops to the min period."""
+        scheduler = PollingScheduler(1, 30, target_batch_lines=100,
+                                     smoothing=0.01)
+        scheduler.update(0, 0.0)
+        self.assertEqual(scheduler.update(100, 30.0), 1)
+
+    def test_idle_backoff(self):
+        """The period grows toward the max as the log goes idle."""
+        scheduler = PollingScheduler(1, 30, target_batch_lines=100)
+        scheduler.update(0, 0.0)
+        scheduler.update(1000, 1.0)
+        periods = []
+        now = 1.0
+        for _ in range(20):
+            now += scheduler.period()
+            periods.append(scheduler.update(0, now))
+        self.assertEqual(periods, sorted(periods))
+        self.assertEqual(periods[-1], 30)
+
+
 class TestNginxAccessLogTailer(unittest.TestCase):
     """Tests for NginxAccessLogTailer."""
 
@@ -24,6 +206,7 @@ class TestNginxAccessLogTailer(unittest.TestCase):
     def test_basic_logging(self, mock_sleep, mock_time, mock_simple_tailer):
         """Ensure basic logging / parsing functionality."""
         mock_simple_tailer_instance = mock_simple_tailer.return_value
+        mock_simple_tailer_instance.backlog_bytes.return_value = 0
         mock_simple_tailer_instance.get_lines.side_effect = [
             [
                 '1.2.3.4 - - [07/Aug/2017:00:00:00 +0000] ' +
@@ -45,9 +228,7 @@ class TestNginxAccessLogTailer(unittest.TestCase):
         tailer = NginxAccessLogTailer('log_file', mock_consumer, 3, 1)
 
         mock_simple_tailer.assert_called_once_with(
-            'log_file',
-            rotation_check_idle_time_s=3,
-            rotation_check_period_s=1)
+            'log_file', max_read_bytes=None)
 
         mock_time.return_value = 0
 
@@ -67,26 +248,38 @@ class TestNginxAccessLogTailer(unittest.TestCase):
             mock.call({
                 'ipaddress': '1.2.3.4',
                 'datetime': '07/Aug/2017:00:00:00 +0000',
+                'method': 'GET',
                 'url': '/',
-                'statuscode': '200'
+                'httpversion': 'HTTP/1.1',
+                'statuscode': '200',
+                'bytessent': '1105'
             }),
             mock.call({
                 'ipaddress': '2.3.4.5',
                 'datetime': '07/Aug/2017:00:00:01 +0000',
+                'method': 'GET',
                 'url': '/',
-                'statuscode': '500'
+                'httpversion': 'HTTP/1.1',
+                'statuscode': '500',
+                'bytessent': '1105'
             }),
             mock.call({
                 'ipaddress': '1.2.3.4',
                 'datetime': '07/Aug/2017:00:00:02 +0000',
+                'method': 'GET',
                 'url': '/',
-                'statuscode': '200'
+                'httpversion': 'HTTP/1.1',
+                'statuscode': '200',
+                'bytessent': '1105'
             }),
             mock.call({
                 'ipaddress': '2.3.4.5',
                 'datetime': '07/Aug/2017:00:00:03 +0000',
+                'method': 'GET',
                 'url': '/',
-                'statuscode': '403'
+                'httpversion': 'HTTP/1.1',
+                'statuscode': '403',
+                'bytessent': '1105'
             }),
         ])
 
@@ -98,14 +291,13 @@ class TestNginxAccessLogTailer(unittest.TestCase):
         mock_consumer = mock.MagicMock(name='Consumer')
 
         mock_simple_tailer_instance = mock_simple_tailer.return_value
+        mock_simple_tailer_instance.backlog_bytes.return_value = 0
         mock_simple_tailer_instance.get_lines.side_effect = [[], [], []]
 
         tailer = NginxAccessLogTailer('log_file', mock_consumer, 3, 1)
 
         mock_simple_tailer.assert_called_once_with(
-            'log_file',
-            rotation_check_idle_time_s=3,
-            rotation_check_period_s=1)
+            'log_file', max_read_bytes=None)
 
         mock_time.return_value = 0
 
@@ -122,12 +314,93 @@ class TestNginxAccessLogTailer(unittest.TestCase):
              mock.call(30)])
         mock_consumer.record.assert_not_called()
 
+    @mock.patch('nginx_access_tailer.nginx_access_log_tailer.SimpleTailer')
+    @mock.patch('time.time')
+    @mock.patch('time.sleep')
+    def test_source(self, mock_sleep, mock_time, mock_simple_tailer):
+        """Lines are read from the provided source instead of a log file."""
+        mock_source = mock.MagicMock(name='Source')
+        mock_source.get_lines.side_effect = [[
+            '1.2.3.4 - - [07/Aug/2017:00:00:00 +0000] ' +
+            '"GET / HTTP/1.1" 200 1105 "-" "SomeClient"',
+        ]]
+        mock_source.backlog_bytes.return_value = 0
+
+        mock_consumer = mock.MagicMock(name='Consumer')
+
+        tailer = NginxAccessLogTailer(None, mock_consumer, source=mock_source)
+
+        mock_simple_tailer.assert_not_called()
+
+        mock_time.return_value = 0
+
+        mock_sleep.side_effect = [SleepExit()]
+        try:
+            tailer.watch(30)
+        except SleepExit:
+            pass
+
+        self.assertEqual(mock_consumer.record.call_count, 1)
+
+    @mock.patch('nginx_access_tailer.nginx_access_log_tailer.time.time')
+    @mock.patch('nginx_access_tailer.nginx_access_log_tailer.time.sleep')
+    def test_source_wait(self, mock_sleep, mock_time):
+        """Sources with a wait method are waited on after the min period."""
+        mock_source = mock.MagicMock(name='Source')
+        mock_source.get_lines.return_value = []
+        mock_source.backlog_bytes.return_value = 0
+        mock_source.wait.side_effect = [None, SleepExit()]
+
+        tailer = NginxAccessLogTailer(
+            None, mock.MagicMock(name='Consumer'), source=mock_source)
+
+        mock_time.return_value = 0
+        try:
+            tailer.watch(1, max_polling_period_s=30, commit_period_s=10)
+        except SleepExit:
+            pass
+
+        mock_sleep.assert_has_calls([mock.call(1), mock.call(1)])
+        # Backed off to the commit period, not the maximum polling period.
+        mock_source.wait.assert_has_calls([mock.call(10), mock.call(10)])
+
+    def test_parse_method_and_version(self):
+        """Request methods and protocol versions beyond GET / 1.1 parse."""
+        tailer = NginxAccessLogTailer('log_file', mock.MagicMock())
+        # pylint: disable=protected-access
+        result = tailer._parse_nginx_access_log(
+            '1.2.3.4 - - [07/Aug/2017:00:00:00 +0000] '
+            '"HEAD /x HTTP/2.0" 204 0 "-" "SomeClient"')
+        self.assertEqual(result['method'], 'HEAD')
+        self.assertEqual(result['url'], '/x')
+        self.assertEqual(result['httpversion'], 'HTTP/2.0')
+        self.assertEqual(result['statuscode'], '204')
+        self.assertEqual(result['bytessent'], '0')
+
+    def test_parse_upstream(self):
+        """The upstream regex captures a trailing upstream field, if any."""
+        tailer = NginxAccessLogTailer(
+            'log_file',
+            mock.MagicMock(),
+            log_regex=NginxAccessLogTailer.NGINX_ACCESS_LOG_UPSTREAM_RE)
+        line = ('1.2.3.4 - - [07/Aug/2017:00:00:00 +0000] '
+                '"GET /x HTTP/1.1" 502 0 "-" "SomeClient"')
+        # pylint: disable=protected-access
+        result = tailer._parse_nginx_access_log(
+            line + ' upstream="10.0.0.1:80, 10.0.0.2:80"')
+        self.assertEqual(result['statuscode'], '502')
+        self.assertEqual(result['upstream'], '10.0.0.1:80, 10.0.0.2:80')
+        result = tailer._parse_nginx_access_log(line)
+        self.assertEqual(result['statuscode'], '502')
+        self.assertIsNone(result['upstream'])
+
     @mock.patch('nginx_access_tailer.nginx_access_log_tailer.SimpleTailer')
     @mock.patch('time.time')
     @mock.patch('time.sleep')
     def test_omit_unparseable(self, mock_sleep, mock_time, mock_simple_tailer):
         """If the tailer provides an unparseable log line, nothing is logged."""
         mock_simple_tailer_instance = mock_simple_tailer.return_value
+        mock_simple_tailer_instance.backlog_bytes.return_value = 0
         mock_simple_tailer_instance.get_lines.side_effect = [
             [
                 '1.2.3.4 - - [07/Aug/2017:00:00:00 +0000] ' +
@@ -140,6 +413,9 @@ class TestNginxAccessLogTailer(unittest.TestCase):
                 # BLAH is not a method
                 '1.2.3.4 - - [07/Aug/2017:00:00:02 +0000] ' +
                 '"BLAH / HTTP/1.1" 200 1105 "-" "SomeClient"',
+                # Nor is this a protocol version
+                '1.2.3.4 - - [07/Aug/2017:00:00:02 +0000] ' +
+                '"GET / HTTP/x" 200 1105 "-" "SomeClient"',
                 '2.3.4.5 - - [07/Aug/2017:00:00:03 +0000] ' +
                 '"GET / HTTP/1.1" 403 1105 "-" "SomeClient"',
             ],
@@ -151,9 +427,7 @@ class TestNginxAccessLogTailer(unittest.TestCase):
         tailer = NginxAccessLogTailer('log_file', mock_consumer, 3, 1)
 
         mock_simple_tailer.assert_called_once_with(
-            'log_file',
-            rotation_check_idle_time_s=3,
-            rotation_check_period_s=1)
+            'log_file', max_read_bytes=None)
 
         mock_time.return_value = 0
 
@@ -173,13 +447,138 @@ class TestNginxAccessLogTailer(unittest.TestCase):
             mock.call({
                 'ipaddress': '1.2.3.4',
                 'datetime': '07/Aug/2017:00:00:00 +0000',
+                'method': 'GET',
                 'url': '/',
-                'statuscode': '200'
+                'httpversion': 'HTTP/1.1',
+                'statuscode': '200',
+                'bytessent': '1105'
             }),
             mock.call({
                 'ipaddress': '2.3.4.5',
                 'datetime': '07/Aug/2017:00:00:03 +0000',
+                'method': 'GET',
                 'url': '/',
-                'statuscode': '403'
+                'httpversion': 'HTTP/1.1',
+                'statuscode': '403',
+                'bytessent': '1105'
             }),
         ])
+
+    @mock.patch('nginx_access_tailer.nginx_access_log_tailer.SimpleTailer')
+    @mock.patch('time.time')
+    @mock.patch('time.sleep')
+    def test_commit_cadence(self, mock_sleep, mock_time, mock_simple_tailer):
+        """Commits happen on their own cadence, independent of polling."""
+        mock_simple_tailer_instance = mock_simple_tailer.return_value
+        mock_simple_tailer_instance.backlog_bytes.return_value = 0
+        mock_simple_tailer_instance.get_lines.return_value = []
+
+        mock_consumer = mock.MagicMock(name='Consumer')
+
+        tailer = NginxAccessLogTailer('log_file', mock_consumer)
+
+        clock = [0.0]
+        passes = [0]
+
+        def fake_sleep(duration):
+            """Advance the fake clock, exiting after a bounded no. of passes."""
+            passes[0] += 1
+            if passes[0] > 10:
+                raise SleepExit()
+            clock[0] += duration
+
+        mock_time.side_effect = lambda: clock[0]
+        mock_sleep.side_effect = fake_sleep
+        try:
+            tailer.watch(5, max_polling_period_s=5, commit_period_s=20)
+        except SleepExit:
+            pass
+
+        # Passes at t = 0, 5, ..., 50: commits at t = 0, 20, 40.
+        self.assertEqual(mock_simple_tailer_instance.get_lines.call_count, 11)
+        self.assertEqual(mock_consumer.commit.call_count, 3)
+
+    @mock.patch('nginx_access_tailer.nginx_access_log_tailer.SimpleTailer')
+    @mock.patch('time.time')
+    @mock.patch('time.sleep')
+    def test_overload_sampling(self, mock_sleep, mock_time, mock_simple_tailer):
+        """Lines are sampled and weighted while lagging behind the log."""
+        line = ('1.2.3.4 - - [07/Aug/2017:00:00:00 +0000] ' +
+                '"GET / HTTP/1.1" 200 1105 "-" "SomeClient"')
+        parsed = {
+            'ipaddress': '1.2.3.4',
+            'datetime': '07/Aug/2017:00:00:00 +0000',
+            'method': 'GET',
+            'url': '/',
+            'httpversion': 'HTTP/1.1',
+            'statuscode': '200',
+            'bytessent': '1105'
+        }
+        mock_simple_tailer_instance = mock_simple_tailer.return_value
+        mock_simple_tailer_instance.get_lines.side_effect = [
+            [line] * 12,
+            [line] * 8,
+            [line] * 2,
+        ]
+        mock_simple_tailer_instance.backlog_bytes.side_effect = [1000, 50, 0]
+
+        mock_consumer = mock.MagicMock(name='Consumer')
+
+        tailer = NginxAccessLogTailer(
+            'log_file',
+            mock_consumer,
+            max_read_bytes=10,
+            max_lag_bytes=100,
+            overload_sample_every=5)
+
+        mock_simple_tailer.assert_called_once_with(
+            'log_file', max_read_bytes=10)
+
+        mock_time.return_value = 0
+
+        # Hack to break out of the watch loop after a bounded number of passes
+        mock_sleep.side_effect = [None, None, SleepExit()]
+        try:
+            tailer.watch(30)
+        except SleepExit:
+            pass
+
+        # Backlog remains after the first two passes: poll again immediately.
+        mock_sleep.assert_has_calls(
+            [mock.call(0), mock.call(0),
+             mock.call(30)])
+        # 20 lines sampled 1 in 5, then 2 counted exactly once caught up.
+        self.assertEqual(mock_consumer.record.call_args_list,
+                         [mock.call(parsed, weight=5)] * 4 +
+                         [mock.call(parsed)] * 2)
+        self.assertEqual(mock_consumer.set_sampling_rate.call_args_list,
+                         [mock.call(0.2), mock.call(1.0)])
+
+    @mock.patch('nginx_access_tailer.nginx_access_log_tailer.SimpleTailer')
+    @mock.patch('time.sleep')
+    def test_stage_timing_and_profiler(self, mock_sleep, mock_simple_tailer):
+        """Stage times are accumulated and the profiler checked each pass."""
+        mock_simple_tailer_instance = mock_simple_tailer.return_value
+        mock_simple_tailer_instance.get_lines.side_effect = [[
+            '1.2.3.4 - - [07/Aug/2017:00:00:00 +0000] ' +
+            '"GET / HTTP/1.1" 200 1105 "-" "SomeClient"',
+        ], []]
+        mock_simple_tailer_instance.backlog_bytes.return_value = 0
+
+        mock_consumer = mock.MagicMock(name='Consumer')
+        mock_profiler = mock.MagicMock(name='Profiler')
+
+        tailer = NginxAccessLogTailer('log_file', mock_consumer)
+
+        mock_sleep.side_effect = [None, SleepExit()]
+        try:
+            tailer.watch(30, profiler=mock_profiler)
+        except SleepExit:
+            pass
+
+        self.assertEqual(mock_profiler.maybe_stop.call_count, 2)
+        self.assertEqual(
+            sorted(tailer.stage_timer().totals()),
+            ['commit', 'parse', 'read', 'record'])
+        self.assertTrue(
+            all(t >= 0 for t in tailer.stage_timer().totals().values()))
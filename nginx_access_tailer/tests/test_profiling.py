@@ -0,0 +1,127 @@
+"""Tests for Profiler and StageTimer."""
+
+import os
+import pstats
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from nginx_access_tailer.profiling import Profiler, StageTimer
+
+
+def burn_cpu(duration_s):
+    """Busy-loop for the given wall time."""
+    deadline = time.time() + duration_s
+    total = 0
+    while time.time() < deadline:
+        total += sum(range(100))
+    return total
+
+
+class TestStageTimer(unittest.TestCase):
+    """Tests for StageTimer."""
+
+    def test_totals(self):
+        """Stage times accumulate until reset."""
+        timer = StageTimer()
+        timer.add('read', 1.0)
+        timer.add('parse', 2.0)
+        timer.add('read', 0.5)
+        self.assertEqual(timer.totals(), {
+            'read': 1.5,
+            'parse': 2.0,
+            'record': 0.0,
+            'commit': 0.0
+        })
+        self.assertIn('parse: 2.000 s', timer.summary())
+        timer.reset()
+        self.assertEqual(sum(timer.totals().values()), 0.0)
+
+
+class TestProfiler(unittest.TestCase):
+    """Tests for Profiler."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmpdir, 'profile')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_invalid_mode(self):
+        """Unknown modes are rejected."""
+        with self.assertRaises(ValueError):
+            Profiler(self.prefix, mode='bogus')
+
+    def test_cprofile(self):
+        """cProfile output is written when the window ends."""
+        timer = StageTimer()
+        timer.add('read', 1.0)
+        profiler = Profiler(self.prefix, duration_s=10, stage_timer=timer)
+        self.assertIsNone(profiler.stop())
+        profiler.start()
+        self.assertTrue(profiler.active())
+        # Starting a window resets the stage timer.
+        self.assertEqual(timer.totals()['read'], 0.0)
+        burn_cpu(0.05)
+        self.assertIsNone(profiler.maybe_stop(time.time()))
+        path = profiler.maybe_stop(time.time() + 10)
+        self.assertFalse(profiler.active())
+        self.assertTrue(path.startswith(self.prefix + '.'))
+        stats = pstats.Stats(path)
+        self.assertTrue(
+            any(func[2] == 'burn_cpu' for func in stats.stats))
+
+    def test_sample(self):
+        """Sampled stacks are written in collapsed form."""
+        profiler = Profiler(
+            self.prefix, mode='sample', sample_interval_s=0.001)
+        profiler.start()
+        burn_cpu(0.2)
+        path = profiler.stop()
+        with open(path) as fprofile:
+            lines = fprofile.readlines()
+        self.assertTrue(lines)
+        self.assertTrue(any('burn_cpu' in line for line in lines))
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertTrue(stack)
+        self.assertTrue(int(count) > 0)
+
+    @mock.patch('time.time')
+    def test_private_output(self, mock_time):
+        """Output is created privately, never through an existing path."""
+        mock_time.return_value = 100
+        prefix = os.path.join(self.tmpdir, 'private', 'profile')
+        profiler = Profiler(prefix, mode='sample')
+        profiler.start()
+        path = profiler.stop()
+        self.assertEqual(path, prefix + '.100')
+        self.assertEqual(os.stat(os.path.dirname(path)).st_mode & 0o777,
+                         0o700)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+        # A symlink planted at the output path is not followed.
+        target = os.path.join(self.tmpdir, 'target')
+        with open(target, 'w') as ftarget:
+            ftarget.write('important')
+        os.symlink(target, self.prefix + '.100')
+        profiler = Profiler(self.prefix, mode='sample')
+        profiler.start()
+        self.assertIsNone(profiler.stop())
+        self.assertFalse(profiler.active())
+        with open(target) as ftarget:
+            self.assertEqual(ftarget.read(), 'important')
+
+    @mock.patch('time.time')
+    def test_one_window_at_a_time(self, mock_time):
+        """Starting a window while one is active has no effect."""
+        mock_time.return_value = 100
+        profiler = Profiler(self.prefix, duration_s=10)
+        profiler.start()
+        mock_time.return_value = 105
+        profiler.start()
+        path = profiler.maybe_stop(110)
+        self.assertEqual(path, self.prefix + '.100')
@@ -0,0 +1,237 @@
+"""Tests for RelayClient and RelayAggregator."""
+
+import datetime
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+
+import mock
+
+from nginx_access_tailer import NginxAccessLogConsumer
+from nginx_access_tailer.relay import RelayAggregator, RelayClient
+
+NGINX_BASE_TIMESTAMP_FORMAT = '%d/%b/%Y:%H:%M:%S'
+
+
+def fake_monitoring_client():
+    """Returns a fake monitoring client with readable metrics and series."""
+    client = mock.MagicMock(name='Client')
+    client.resource.side_effect = lambda type_, labels: (
+        type_, tuple(sorted(labels.items())))
+    client.metric.side_effect = lambda type_, labels: (
+        type_, tuple(sorted(labels.items())))
+    client.time_series.side_effect = (
+        lambda metric, resource, value, start_time: (metric, resource, value))
+    return client
+
+
+def written_series(client):
+    """Returns a dict of (metric, resource) => value written to client."""
+    series = {}
+    for call in client.write_time_series.call_args_list:
+        for metric, resource, value in call[0][0]:
+            series[(metric, resource)] = value
+    return series
+
+
+def run_tailer(address, instance_id, codes):
+    """Record a response per status code, committing twice, via the relay."""
+    client = RelayClient(address)
+    resource = client.resource(
+        'gce_instance', labels={'instance_id': instance_id,
+                                'zone': 'z'})
+    consumer = NginxAccessLogConsumer(client, resource, 'custom/foo')
+    timestamp = '%s +0000' % (
+        consumer.reset_time_utc() + datetime.timedelta(seconds=10)).strftime(
+            NGINX_BASE_TIMESTAMP_FORMAT)
+    half = len(codes) // 2
+    for batch in (codes[:half], codes[half:]):
+        for code in batch:
+            consumer.record({'datetime': timestamp, 'statuscode': code})
+        consumer.commit()
+    client.close()
+
+
+class TestRelay(unittest.TestCase):
+    """Tests for relaying points from tailers through the aggregator."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.address = 'unix:%s' % os.path.join(self.tmpdir, 'relay.sock')
+        self.client = fake_monitoring_client()
+        self.aggregator = RelayAggregator(self.client, self.address)
+
+    def tearDown(self):
+        self.aggregator.close()
+        shutil.rmtree(self.tmpdir)
+
+    def drain(self, polls=10):
+        """Process any pending relayed input."""
+        for _ in range(polls):
+            self.aggregator.poll(0.05)
+
+    def test_multiple_tailer_processes(self):
+        """Counter deltas from several processes are merged per resource."""
+        tailers = [
+            ('1', ['200', '200', '500', '200']),
+            ('2', ['200', '404']),
+            # A second tailer process for the same instance.
+            ('1', ['200', '500']),
+        ]
+        processes = [
+            multiprocessing.Process(
+                target=run_tailer, args=(self.address, instance_id, codes))
+            for instance_id, codes in tailers
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        self.drain()
+        self.aggregator.flush()
+
+        def key(instance_id, code):
+            """Returns the (metric, resource) key of a series."""
+            return (('custom/foo', (('response_code', code),)),
+                    ('gce_instance', (('instance_id', instance_id),
+                                      ('zone', 'z'))))
+
+        self.assertEqual(
+            written_series(self.client), {
+                key('1', '200'): 4,
+                key('1', '500'): 2,
+                key('2', '200'): 1,
+                key('2', '404'): 1,
+            })
+        # All series were written in a single batch.
+        self.client.write_time_series.assert_called_once()
+        self.client.time_series.assert_called_with(
+            mock.ANY, mock.ANY, mock.ANY, start_time=mock.ANY)
+
+        # Nothing further to write.
+        self.client.write_time_series.reset_mock()
+        self.aggregator.flush()
+        self.client.write_time_series.assert_not_called()
+
+    def test_batch_size_and_gauges(self):
+        """Writes are split into batches; gauges have no start time."""
+        self.aggregator.close()
+        self.aggregator = RelayAggregator(
+            self.client, self.address, max_batch=2)
+        client = RelayClient(self.address)
+        resource = client.resource('r', labels={})
+        for i in range(3):
+            client.write_point(
+                client.metric('c%d' % i, labels={}),
+                resource,
+                i,
+                start_time=datetime.datetime.utcnow())
+        client.write_point(client.metric('g', labels={}), resource, 0.5)
+        client.close()
+        self.drain()
+        self.aggregator.flush()
+        self.assertEqual(self.client.write_time_series.call_count, 2)
+        self.assertEqual(written_series(self.client)[(('g', ()), ('r', ()))],
+                         0.5)
+        self.client.time_series.assert_any_call(
+            ('g', ()), ('r', ()), 0.5, start_time=None)
+
+    def test_aggregator_unavailable(self):
+        """Deltas accumulate while the aggregator cannot be reached."""
+        self.aggregator.close()
+        client = RelayClient(self.address, reconnect_period_s=0)
+        resource = client.resource('r', labels={})
+        metric = client.metric('c', labels={})
+        start_time = datetime.datetime.utcnow()
+        # Does not raise.
+        client.write_point(metric, resource, 5, start_time=start_time)
+
+        self.aggregator = RelayAggregator(self.client, self.address)
+        client.write_point(metric, resource, 7, start_time=start_time)
+        client.write_point(metric, resource, 8, start_time=start_time)
+        client.close()
+        self.drain()
+        self.aggregator.flush()
+        self.assertEqual(written_series(self.client), {
+            (('c', ()), ('r', ())): 8
+        })
+
+    def test_flush_failure(self):
+        """Series that fail to be written are retried on the next flush."""
+        client = RelayClient(self.address)
+        resource = client.resource('r', labels={})
+        metric = client.metric('c', labels={})
+        start_time = datetime.datetime.utcnow()
+        client.write_point(metric, resource, 5, start_time=start_time)
+        self.drain()
+        self.client.write_time_series.side_effect = IOError('down')
+        # Does not raise.
+        self.aggregator.flush()
+
+        client.write_point(metric, resource, 7, start_time=start_time)
+        client.close()
+        self.drain()
+        self.client.write_time_series.reset_mock()
+        self.client.write_time_series.side_effect = None
+        self.aggregator.flush()
+        self.client.write_time_series.assert_called_once_with(
+            [(('c', ()), ('r', ()), 7)])
+
+    def test_does_not_remove_other_files(self):
+        """A file at the socket path that is not a socket is left alone."""
+        path = os.path.join(self.tmpdir, 'other')
+        with open(path, 'w') as fout:
+            fout.write('important')
+        self.assertRaises(socket.error, RelayAggregator, self.client,
+                          'unix:%s' % path)
+        with open(path) as fin:
+            self.assertEqual(fin.read(), 'important')
+
+    def test_malformed_frames(self):
+        """Malformed frames drop the connection, not the aggregator."""
+        good = json.dumps({
+            'resource': {'type': 'r', 'labels': {}},
+            'metric': {'type': 'c', 'labels': {}},
+            'cumulative': True,
+        })
+        bad_labels = json.dumps({
+            'resource': {'type': 'r', 'labels': ['x']},
+            'metric': {'type': 'c', 'labels': {}},
+            'cumulative': True,
+        })
+        records = [
+            b'',
+            b'C',
+            b'X' + struct.pack('!Iq', 0, 1),
+            struct.pack('!cIq', 'C', 7, 1),
+            struct.pack('!cIH', 'D', 0, len(good) + 1) + good,
+            struct.pack('!cIH', 'D', 0, 4) + 'nope',
+            struct.pack('!cIH', 'D', 0, 2) + '[]',
+            struct.pack('!cIH', 'D', 0, len(bad_labels)) + bad_labels,
+        ]
+        for record in records:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(self.address[len('unix:'):])
+            conn.sendall(struct.pack('!I', len(record)) + record)
+            # Does not raise.
+            self.drain()
+            self.assertEqual(conn.recv(1), b'')
+            conn.close()
+
+        # Still serving.
+        client = RelayClient(self.address)
+        client.write_point(client.metric('c', labels={}),
+                           client.resource('r', labels={}), 3,
+                           start_time=datetime.datetime.utcnow())
+        client.close()
+        self.drain()
+        self.aggregator.flush()
+        self.assertEqual(written_series(self.client), {
+            (('c', ()), ('r', ())): 3
+        })
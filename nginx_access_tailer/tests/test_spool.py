@@ -0,0 +1,113 @@
+"""Tests for Spool."""
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from nginx_access_tailer.spool import Spool, SpooledPoint
+
+
+def make_point(i, start_time=datetime.datetime(2017, 8, 7, 0, 0, 0)):
+    """Returns a distinct SpooledPoint for index i."""
+    return SpooledPoint('custom/foo', {'response_code': str(i)}, i, start_time,
+                        datetime.datetime(2017, 8, 7, 1, 0, 0, 250000) +
+                        datetime.timedelta(seconds=i))
+
+
+def drain(spool, limit=None):
+    """Returns the unread points in the spool, consuming them."""
+    points = []
+    while limit is None or len(points) < limit:
+        point = spool.peek()
+        if point is None:
+            break
+        points.append(point)
+        spool.advance()
+    return points
+
+
+class TestSpool(unittest.TestCase):
+    """Tests for Spool."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmpdir, 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        """Points are read back in order, with all fields preserved."""
+        spool = Spool(self.directory)
+        self.assertTrue(spool.empty())
+        self.assertIsNone(spool.peek())
+        gauge = SpooledPoint(u'custom/rate', {}, 0.25, None,
+                             datetime.datetime(2017, 8, 7, 2, 0, 0))
+        spool.append([make_point(1), gauge])
+        spool.append([make_point(2)])
+        self.assertFalse(spool.empty())
+        # Peeking does not consume.
+        self.assertEqual(spool.peek(), make_point(1))
+        self.assertEqual(drain(spool), [make_point(1), gauge, make_point(2)])
+        self.assertTrue(spool.empty())
+
+    def test_reopen(self):
+        """The persisted read position survives reopening the spool."""
+        spool = Spool(self.directory)
+        spool.append([make_point(i) for i in range(5)])
+        self.assertEqual(drain(spool, limit=2), [make_point(0), make_point(1)])
+        spool.sync_head()
+        # Unsynced progress is replayed after reopening.
+        drain(spool, limit=1)
+
+        spool = Spool(self.directory)
+        self.assertEqual(drain(spool), [make_point(i) for i in range(2, 5)])
+
+    def test_truncated_tail(self):
+        """A partially written final record is discarded on reopening."""
+        spool = Spool(self.directory)
+        spool.append([make_point(1), make_point(2)])
+        segment = os.path.join(self.directory, os.listdir(self.directory)[0])
+        with open(segment, 'r+b') as fseg:
+            fseg.truncate(os.path.getsize(segment) - 3)
+
+        spool = Spool(self.directory)
+        spool.append([make_point(3)])
+        self.assertEqual(drain(spool), [make_point(1), make_point(3)])
+
+    def test_failed_append(self):
+        """A batch that fails to sync is discarded, not left half-written."""
+        spool = Spool(self.directory)
+        spool.append([make_point(1)])
+        size = spool.size_bytes()
+        with mock.patch('os.fsync',
+                        side_effect=OSError(28, 'No space left on device')):
+            self.assertRaises(OSError, spool.append,
+                              [make_point(2), make_point(3)])
+        self.assertEqual(spool.size_bytes(), size)
+        spool.append([make_point(4)])
+        self.assertEqual(drain(spool), [make_point(1), make_point(4)])
+
+    def test_eviction(self):
+        """The oldest points are evicted once the size limit is reached."""
+        spool = Spool(self.directory, max_bytes=4000, segment_bytes=500)
+        spool.append([make_point(0)])
+        record_bytes = spool.size_bytes()
+        for i in range(1, 200):
+            spool.append([make_point(i)])
+            self.assertLessEqual(spool.size_bytes(), 4000)
+        points = drain(spool)
+        # Only the most recent points remain, in order.
+        self.assertGreater(len(points), 2000 // record_bytes)
+        self.assertEqual(points, [make_point(i)
+                                  for i in range(200 - len(points), 200)])
+        # Consumed segments are removed.
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
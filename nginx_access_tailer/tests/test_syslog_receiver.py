@@ -0,0 +1,155 @@
+"""Tests for SyslogReceiver."""
+
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+import mock
+
+from nginx_access_tailer import SyslogReceiver
+
+LOG_LINE = ('1.2.3.4 - - [07/Aug/2017:00:00:00 +0000] '
+            '"GET / HTTP/1.1" 200 1105 "-" "SomeClient"')
+
+
+def syslog_datagram(payload, hostname='myhost'):
+    """Returns payload with an nginx-style syslog header."""
+    if hostname:
+        return '<190>Aug  7 00:00:00 %s nginx: %s' % (hostname, payload)
+    return '<190>Aug  7 00:00:00 nginx: %s' % payload
+
+
+class TestSyslogReceiver(unittest.TestCase):
+    """Tests for SyslogReceiver, using a local sender."""
+
+    def setUp(self):
+        self.receiver = SyslogReceiver('127.0.0.1:0', max_datagram_bytes=512)
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def send(self, datagram):
+        """Send a datagram to the receiver."""
+        self.sender.sendto(datagram, self.receiver.address())
+
+    def test_nothing_received(self):
+        """get_lines returns an empty list if nothing has been sent."""
+        self.assertEqual(self.receiver.get_lines(), [])
+        self.assertEqual(self.receiver.backlog_bytes(), 0)
+
+    def test_strips_header(self):
+        """The syslog header is stripped, with or without a hostname."""
+        self.send(syslog_datagram(LOG_LINE))
+        self.send(syslog_datagram(LOG_LINE, hostname=None))
+        self.assertEqual(self.receiver.get_lines(), [LOG_LINE, LOG_LINE])
+        self.assertEqual(self.receiver.get_lines(), [])
+
+    def test_oversized_and_malformed(self):
+        """Oversized and malformed datagrams are discarded and counted."""
+        self.send(syslog_datagram('x' * 1024))
+        self.send('no header here')
+        self.send('<190>no delimiter')
+        self.send(syslog_datagram(LOG_LINE))
+        self.assertEqual(self.receiver.get_lines(), [LOG_LINE])
+        stats = self.receiver.stats()
+        self.assertEqual(stats['received'], 4)
+        self.assertEqual(stats['oversized'], 1)
+        self.assertEqual(stats['malformed'], 2)
+        self.assertIn(stats['dropped'], (0, None))
+
+    def test_max_datagram_size(self):
+        """Datagrams of exactly the maximum size are accepted."""
+        header = syslog_datagram('')
+        payload = 'x' * (512 - len(header))
+        self.send(header + payload)
+        self.assertEqual(self.receiver.get_lines(), [payload])
+
+    def test_batching(self):
+        """At most max_batch datagrams are returned per call."""
+        receiver = SyslogReceiver('127.0.0.1:0', max_batch=3)
+        try:
+            for i in range(5):
+                self.sender.sendto(syslog_datagram(str(i)), receiver.address())
+            self.assertEqual(receiver.get_lines(), ['0', '1', '2'])
+            # A full batch is reported as backlog, to be read immediately.
+            self.assertGreater(receiver.backlog_bytes(), 0)
+            self.assertEqual(receiver.get_lines(), ['3', '4'])
+            self.assertEqual(receiver.backlog_bytes(), 0)
+        finally:
+            receiver.close()
+
+    def test_kernel_drops_logged(self):
+        """Increases in kernel drops are logged."""
+        # pylint: disable=protected-access
+        _, base = self.receiver._socket_queue()
+        if base is None:
+            self.skipTest('kernel drop counts not available')
+        with mock.patch.object(self.receiver, '_socket_queue',
+                               return_value=(0, base + 7)), \
+                mock.patch('nginx_access_tailer.syslog_receiver.logging') \
+                as mock_logging:
+            self.receiver.get_lines()
+            self.assertEqual(self.receiver.stats()['dropped'], 7)
+            mock_logging.warning.assert_called_once()
+            # Unchanged: not logged again.
+            self.receiver.get_lines()
+            mock_logging.warning.assert_called_once()
+
+    def test_wait(self):
+        """wait returns once a datagram arrives, or after the timeout."""
+        t_start = time.time()
+        self.receiver.wait(0.05)
+        self.assertGreaterEqual(time.time() - t_start, 0.04)
+        self.send(syslog_datagram(LOG_LINE))
+        t_start = time.time()
+        self.receiver.wait(10)
+        self.assertLess(time.time() - t_start, 5)
+        self.assertEqual(self.receiver.get_lines(), [LOG_LINE])
+
+    def test_small_receive_buffer_logged(self):
+        """A receive buffer smaller than requested is logged."""
+        with mock.patch('nginx_access_tailer.syslog_receiver.logging') \
+                as mock_logging:
+            SyslogReceiver('127.0.0.1:0', rcvbuf_bytes=1 << 30).close()
+        mock_logging.warning.assert_called_once()
+
+
+class TestSyslogReceiverUnix(unittest.TestCase):
+    """Tests for SyslogReceiver on a unix datagram socket."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'nginx.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_unix_socket(self):
+        """Lines are received on a unix socket, which is removed on close."""
+        # A stale socket file from a previous run is replaced.
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(self.path)
+        stale.close()
+        receiver = SyslogReceiver('unix:%s' % self.path)
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sender.sendto(syslog_datagram(LOG_LINE), self.path)
+            self.assertEqual(receiver.get_lines(), [LOG_LINE])
+            self.assertIsNone(receiver.stats()['dropped'])
+        finally:
+            sender.close()
+            receiver.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_does_not_remove_other_files(self):
+        """A file at the socket path that is not a socket is left alone."""
+        with open(self.path, 'w') as fout:
+            fout.write('important')
+        self.assertRaises(socket.error, SyslogReceiver, 'unix:%s' % self.path)
+        with open(self.path) as fin:
+            self.assertEqual(fin.read(), 'important')